@@ -1,17 +1,47 @@
 #!/usr/bin/env python3
 import subprocess
-import sys
 import os
 import re
 import json
 import threading
-import queue
 import time
 import shutil
-from urllib.parse import quote, unquote
-from flask import Flask, render_template_string, request, send_from_directory, flash, url_for, Response, redirect, session, jsonify
+import tempfile
+import atexit
+import uuid
+import hashlib
+import gzip
+import zlib
+import copy
+import socket
+from functools import lru_cache, partial
+from operator import itemgetter
+from contextlib import contextmanager
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote, urlsplit, urlunsplit, parse_qsl, urlencode
+from flask import (Flask, request, send_from_directory, flash, get_flashed_messages, url_for, Response, redirect,
+                   session, jsonify, abort, stream_with_context)
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from itsdangerous import URLSafeSerializer, BadSignature
+from jinja2 import ChoiceLoader, DictLoader
+from markupsafe import escape
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import av  # PyAV: probe media in-process instead of spawning ffprobe
+except ImportError:
+    av = None
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import yt_dlp
 
 # -----------------------------
@@ -20,16 +50,127 @@ import yt_dlp
 FLASK_PORT = int(os.environ.get("PORT", 5000))
 DOWNLOAD_FOLDER = os.path.join('/tmp', 'downloads')
 os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
+DOWNLOAD_ROOT = os.path.abspath(DOWNLOAD_FOLDER)
+
+def download_path(rel_path):
+    """Resolves a user-supplied path under DOWNLOAD_FOLDER, or None if it escapes it.
+
+    commonpath compares whole components, so "/tmp/downloads-evil" doesn't pass
+    for "/tmp/downloads" the way a startswith() check would.
+    """
+    full_path = os.path.normpath(os.path.join(DOWNLOAD_ROOT, rel_path))
+    return full_path if os.path.commonpath([DOWNLOAD_ROOT, full_path]) == DOWNLOAD_ROOT else None
+
+def existing_download(rel_path):
+    """Like download_path, but also None unless the path is an existing regular file."""
+    full_path = download_path(rel_path)
+    return full_path if full_path is not None and os.path.isfile(full_path) else None
 
 COOKIES_FILE = os.path.join('/tmp', 'youtube_cookies.txt')
 cookie_content = os.environ.get('YOUTUBE_COOKIES_CONTENT')
 if cookie_content:
-    with open(COOKIES_FILE, 'w') as f:
+    # A private per-process file (mode 0600): restarted or concurrent workers never
+    # race on one shared path, and the cookies are not left world-readable.
+    fd, COOKIES_FILE = tempfile.mkstemp(prefix='youtube_cookies_', suffix='.txt')
+    with os.fdopen(fd, 'w') as f:
         f.write(cookie_content)
-        
-PIXELDRAIN_API_KEY = os.environ.get("PIXELDRAIN_API_KEY", "")
 
-print(f"📂 Downloads folder: {os.path.abspath(DOWNLOAD_FOLDER)}")
+    def _remove_cookies_file(path=COOKIES_FILE, owner=os.getpid()):
+        # A forked child inherits this handler; only the process that wrote the file removes it.
+        if os.getpid() == owner:
+            os.remove(path)
+    atexit.register(_remove_cookies_file)
+
+PIXELDRAIN_API_KEY = os.environ.get("PIXELDRAIN_API_KEY", "")
+# Maximum number of download/encode/upload jobs running at once.
+MAX_JOBS = int(os.environ.get("MAX_JOBS", 3))
+# Parallel fragment downloads for HLS/DASH formats (yt-dlp -N).
+YT_DLP_FRAGMENTS = int(os.environ.get("YT_DLP_FRAGMENTS", 8))
+# yt-dlp caches YouTube player signature/nsig code here, so extractions after the
+# first skip re-downloading and re-parsing the player JS. The default (~/.cache)
+# is often missing or read-only on PaaS hosts, which silently disables the cache.
+YT_DLP_CACHE_DIR = os.environ.get("YT_DLP_CACHE_DIR", os.path.join(tempfile.gettempdir(), "yt-dlp-cache"))
+os.makedirs(YT_DLP_CACHE_DIR, exist_ok=True)
+# Larger download buffer and ranged HTTP chunks so yt-dlp issues fewer, bigger writes.
+YT_DLP_BUFFER_SIZE = 16 * 1024 * 1024
+YT_DLP_HTTP_CHUNK_SIZE = 10 * 1024 * 1024
+
+# Absolute executable paths plus close_fds=False let subprocess launch children with
+# posix_spawn() instead of fork()+exec(), so a busy worker's page tables aren't
+# copied for every ffmpeg/yt-dlp run. Python's own fds are non-inheritable
+# (PEP 446), so keeping fds open leaks nothing into the child.
+FFMPEG = shutil.which("ffmpeg") or "ffmpeg"
+FFPROBE = shutil.which("ffprobe") or "ffprobe"
+# rm(1) unlinks a large tree without a Python call per entry; delete_file falls
+# back to shutil.rmtree where it isn't available.
+RM = shutil.which("rm") if os.name == "posix" else None
+SPAWN_KWARGS = {"close_fds": False}
+
+# Behind nginx, hand file downloads to it with X-Accel-Redirect so the kernel
+# sendfile()s them and no Python thread is tied up. Set to an internal location:
+#   location /protected/ { internal; alias /tmp/downloads/; sendfile on; }
+X_ACCEL_PREFIX = os.environ.get("X_ACCEL_PREFIX", "")
+# The same for Apache (mod_xsendfile) / lighttpd: send_from_directory then answers
+# with an X-Sendfile header naming the absolute path instead of the file body.
+USE_X_SENDFILE = os.environ.get("USE_X_SENDFILE", "").lower() in ("1", "true", "yes")
+
+# One pooled session so Pixeldrain uploads and direct downloads reuse TCP/TLS
+# connections. Status retries skip PUT: a streamed upload body cannot be replayed
+# once sent.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=20, pool_maxsize=100,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504], allowed_methods=["GET", "POST"])
+))
+# Process-wide getaddrinfo cache: yt-dlp, requests and urllib3 all resolve the same
+# few hosts over and over. Failed lookups are not cached. DNS_CACHE_TTL=0 disables it.
+DNS_CACHE_TTL = int(os.environ.get("DNS_CACHE_TTL", 300))
+DNS_CACHE_MAX = 256
+DNS_PREWARM_HOSTS = ("www.youtube.com", "youtube.com", "pixeldrain.com")
+_DNS_CACHE = {}
+_DNS_CACHE_LOCK = threading.Lock()
+_real_getaddrinfo = socket.getaddrinfo
+
+def _cached_getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+    key = (host, port, family, type, proto, flags)
+    now = time.monotonic()
+    with _DNS_CACHE_LOCK:
+        entry = _DNS_CACHE.get(key)
+    if entry and entry[0] > now:
+        return list(entry[1])
+    result = _real_getaddrinfo(host, port, family, type, proto, flags)
+    with _DNS_CACHE_LOCK:
+        if len(_DNS_CACHE) >= DNS_CACHE_MAX:
+            del _DNS_CACHE[next(iter(_DNS_CACHE))]
+        _DNS_CACHE[key] = (now + DNS_CACHE_TTL, tuple(result))
+    return result
+
+def _prewarm_dns():
+    for host in DNS_PREWARM_HOSTS:
+        try:
+            socket.getaddrinfo(host, 443, 0, socket.SOCK_STREAM)
+        except OSError:
+            pass
+
+if DNS_CACHE_TTL > 0:
+    socket.getaddrinfo = _cached_getaddrinfo
+    threading.Thread(target=_prewarm_dns, name="dns-prewarm", daemon=True).start()
+
+# (connect, read) timeouts for Pixeldrain calls, so a stalled connection fails the
+# job instead of pinning a worker forever. The read timeout is per socket read,
+# not for the whole upload.
+PIXELDRAIN_TIMEOUT = (10, 300)
+# The same for direct downloads: a server that stops sending fails the job.
+DIRECT_DOWNLOAD_TIMEOUT = (10, 120)
+
+# Reverse proxies drop SSE connections idle for ~60s, so send a heartbeat well before
+# that. It is a named event rather than a comment so the page's watchdog can see it.
+SSE_HEARTBEAT_SECONDS = 15
+SSE_HEARTBEAT_FRAME = b"event: heartbeat\ndata:\n\n"
+# Browser reconnect delay (ms) after a dropped stream; the default is ~3s.
+SSE_RETRY_FRAME = b"retry: 2000\n\n"
+
+print(f"📂 Downloads folder: {DOWNLOAD_ROOT}")
 print(f"🍪 Cookies: {'Loaded' if os.path.exists(COOKIES_FILE) else 'Not found'}")
 
 # -----------------------------
@@ -37,71 +178,258 @@ print(f"🍪 Cookies: {'Loaded' if os.path.exists(COOKIES_FILE) else 'Not found'
 # -----------------------------
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "super_secret_key_2025")
-progress_queue = queue.Queue()
+app.config["USE_X_SENDFILE"] = USE_X_SENDFILE
+
+# Each job gets its own progress channel so concurrent jobs never share a stream.
+# Jobs run on a bounded pool; extra submissions wait for a free worker.
+JOBS = {}
+JOBS_LOCK = threading.Lock()
+EXECUTOR = ThreadPoolExecutor(max_workers=MAX_JOBS, thread_name_prefix="job")
+# Finished jobs stay watchable this long (late tabs, reconnects) before being dropped.
+JOB_RETENTION_SECONDS = 60
+
+def sse_event(msg):
+    """Encodes one progress message as an SSE data frame (orjson when installed)."""
+    if orjson is not None:
+        return b"data: " + orjson.dumps(msg) + b"\n\n"
+    return f"data: {json.dumps(msg)}\n\n".encode()
+
+class JobCancelled(Exception):
+    pass
+
+class ProgressChannel:
+    """Fans a job's progress messages out to every connected SSE client.
+
+    Each subscriber gets its own bounded deque plus an Event to wake it. A copy of
+    recent history seeds new subscribers, so a tab that connects late (or a second
+    tab) still sees the whole log. Bounded deques drop the oldest messages instead
+    of growing when a client stops reading.
+
+    Messages are encoded to SSE frames once in put() and queued as (frame, is_done)
+    pairs, so extra viewers cost no extra serialization. Each frame carries an
+    increasing "id:", so a browser reconnecting with Last-Event-ID only gets the
+    messages it missed.
+
+    The channel is also the worker's handle on its job: /cancel sets `cancelled`,
+    and workers call check_cancelled() between steps and inside their read loops.
+
+    `progress` holds the latest (stage, percent) for /status. It is a single
+    attribute that writers overwrite and readers copy, so it needs no lock.
+    """
+    def __init__(self, maxlen=1024):
+        self.maxlen = maxlen
+        self.history = deque(maxlen=maxlen)  # (id, frame, is_done)
+        self.last_id = 0
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.done_at = None
+        self.cancelled = threading.Event()
+        self.progress = None
+
+    def put(self, msg):
+        done = msg.get("log") == "DONE"
+        if "percent" in msg:
+            self.progress = (msg.get("stage"), msg["percent"])
+        data = sse_event(msg)
+        with self.lock:
+            self.last_id += 1
+            item = (b"id: %d\n" % self.last_id + data, done)
+            self.history.append((self.last_id, *item))
+            for messages, event in self.subscribers:
+                messages.append(item)
+                event.set()
+            if done:
+                self.done_at = time.monotonic()
+
+    def subscribe(self, after_id=0):
+        event = threading.Event()
+        with self.lock:
+            messages = deque(((frame, done) for msg_id, frame, done in self.history if msg_id > after_id),
+                             maxlen=self.maxlen)
+            self.subscribers.append((messages, event))
+        event.set()
+        return messages, event
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise JobCancelled("Cancelled by user.")
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription in self.subscribers:
+                self.subscribers.remove(subscription)
+
+def create_job():
+    job_id = uuid.uuid4().hex
+    q = ProgressChannel()
+    now = time.monotonic()
+    with JOBS_LOCK:
+        for old_id in [jid for jid, job in JOBS.items()
+                       if job["channel"].done_at and now - job["channel"].done_at > JOB_RETENTION_SECONDS]:
+            del JOBS[old_id]
+        JOBS[job_id] = {"channel": q, "future": None}
+    return job_id, q
+
+def submit_job(job_id, fn, *args, **kwargs):
+    with JOBS_LOCK:
+        job = JOBS[job_id]
+    channel = job["channel"]
+    # Shown until the worker's own first message replaces it.
+    channel.put({"stage": "Queued, waiting for a free worker..."})
+
+    # DONE is sent here, once per job, not by the workers: encode_file and
+    # upload_to_pixeldrain also run as steps inside other jobs, and a DONE from
+    # them would end the stream and redirect the page mid-job.
+    def run():
+        try:
+            fn(*args, **kwargs)
+        finally:
+            channel.put({"log": "DONE"})
+    job["future"] = EXECUTOR.submit(run)
+
+# Progress and cancel URLs carry a signed job id, so the raw ids listed by /status
+# can't be used to watch or cancel someone else's job.
+JOB_SIGNER = URLSafeSerializer(app.secret_key, salt="job-id")
+
+def job_token(job_id):
+    return JOB_SIGNER.dumps(job_id)
+
+def lookup_job(token):
+    """Returns the job a signed token refers to, or None for a bad token or a dropped job."""
+    try:
+        job_id = JOB_SIGNER.loads(token)
+    except BadSignature:
+        return None
+    with JOBS_LOCK:
+        return JOBS.get(job_id)
+
+@lru_cache(maxsize=None)
+def static_version(filename):
+    """Short content hash used to cache-bust long-lived static assets."""
+    with open(os.path.join(app.static_folder, filename), 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:10]
+
+def static_url(filename):
+    return url_for('static', filename=filename, v=static_version(filename))
+
+app.jinja_env.globals['static_url'] = static_url
+app.jinja_env.globals['job_token'] = job_token
+
+@app.after_request
+def add_static_cache_headers(response):
+    # Versioned asset URLs change whenever the file does, so browsers may keep them forever.
+    if request.endpoint == 'static' and request.args.get('v'):
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+# Pages and static assets are small text that compresses several-fold. SSE streams
+# are left alone (gzip would hold events back until its buffer fills), and so are
+# downloads, which are already-compressed media.
+COMPRESSIBLE_MIMETYPES = {'text/html', 'text/css', 'text/javascript', 'application/javascript', 'application/json'}
+COMPRESS_MIN_SIZE = 512
+
+def gzip_stream(chunks):
+    """Gzips a streamed body, sync-flushing after every chunk so each one goes out as it renders.
+
+    Without the flush zlib holds its output until its buffer fills, which for a page
+    of a few thousand rows means until the end. The buffered template hands over
+    several rows per chunk, so the extra flush markers cost little ratio.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+            yield data + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or 'Content-Encoding' in response.headers or 'X-Sendfile' in response.headers
+            or 'gzip' not in request.headers.get('Accept-Encoding', '')):
+        return response
+    if response.direct_passthrough:
+        if request.endpoint != 'static':
+            return response
+        response.direct_passthrough = False  # a small asset file; read it to compress it
+    elif response.is_streamed:
+        # Only pages stream here (SSE is not a compressible type); their size is unknown.
+        response.response = gzip_stream(response.response)
+        response.headers.pop('Content-Length', None)
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag:
+        # The gzip variant gets its own ETag, and that is what the browser sends
+        # back in If-None-Match; Flask's own check only knew the plain one, so
+        # answer the revalidation here, before doing the compression.
+        response.set_etag(etag + '-gzip', weak)
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
 
 # -----------------------------
 # Templates (main + encode + operation)
 # -----------------------------
+# Fragments shared by the page templates, pulled in with {% include %}.
+PARTIAL_TEMPLATES = {
+    "_flashes.html": """
+{% with messages = get_flashed_messages(with_categories=true) %}
+    {% for category, message in messages %}
+        <div class="flash-msg flash-{{ category }}">{{ message|safe }}</div>
+    {% endfor %}
+{% endwith %}
+""",
+    "_progress.html": """
+<div id="progress-container" class="progress-container">
+    <h3 id="progress-stage">Starting...</h3>
+    <div class="progress-bar">
+        <div id="progress-bar-inner" class="progress-bar-inner"{% if progress_bar_color %} style="background-color: {{ progress_bar_color }};"{% endif %}>0%</div>
+    </div>
+    <pre id="progress-log"></pre>
+    <button type="button" id="progress-cancel" class="delete" style="display: none;">Cancel</button>
+</div>
+""",
+    "_watch_progress.html": """
+{% if download_started %}
+<script>
+    document.addEventListener("DOMContentLoaded", function() {
+        watchProgress("{{ url_for('progress_stream', token=job_token(job_id)) }}", "{{ url_for('list_files') }}", "{{ url_for('operation_complete') }}", "{{ url_for('cancel_job', token=job_token(job_id)) }}");
+    });
+</script>
+{% endif %}
+""",
+}
+
 TEMPLATE = """
+{% macro size_label(f) %}{{ f.size|human_size if f.size else 'Unknown' }}{% endmacro %}
+{% macro video_label(f) %}{{ f.h }}p {{ f.fps }}fps {{ f.vcodec|upper }}{% if f.is_muxed %}+{{ f.acodec|upper }}{% else %} ~{{ f.vbr|int }}k{% endif %} ({{ size_label(f) }}){% endmacro %}
+{% macro audio_label(f) %}{{ f.acodec|upper }} {{ f.br|int }}kbps ({{ size_label(f) }}){% endmacro %}
 <!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
     <title>Video Downloader</title>
-    <style>
-        body { font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Helvetica, Arial, sans-serif; line-height: 1.6; background-color: #f4f4f9; color: #333; margin: 0; padding: 20px; }
-        .container { max-width: 800px; margin: auto; background: #fff; padding: 20px; border-radius: 8px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }
-        h1, h2, h3 { color: #444; }
-        hr { border: 0; border-top: 1px solid #ddd; margin: 20px 0; }
-        input[type="text"], input[type="number"], select { width: 100%; padding: 8px; margin: 5px 0 15px; border: 1px solid #ccc; border-radius: 4px; box-sizing: border-box; }
-        input[type="file"] { margin-bottom: 15px; }
-        button { background-color: #007bff; color: white; padding: 10px 15px; border: none; border-radius: 4px; cursor: pointer; font-size: 16px; margin-right: 5px; }
-        button:hover { background-color: #0056b3; }
-        button.delete { background-color: #dc3545; }
-        button.delete:hover { background-color: #c82333; }
-        button.upload { background-color: #17a2b8; }
-        button.upload:hover { background-color: #138496; }
-        button.encode { background-color: #28a745; }
-        button.encode:hover { background-color: #218838; }
-        button.rename { background-color: #ffc107; color: #212529; }
-        button.rename:hover { background-color: #e0a800; }
-        a { color: #007bff; text-decoration: none; }
-        a:hover { text-decoration: underline; }
-        pre { background-color: #eee; padding: 10px; border-radius: 4px; white-space: pre-wrap; word-wrap: break-word; }
-        .flash-msg { padding: 10px; border-radius: 4px; margin-bottom: 15px; }
-        .flash-success { background-color: #d4edda; color: #155724; border: 1px solid #c3e6cb; }
-        .flash-error { background-color: #f8d7da; color: #721c24; border: 1px solid #f5c6cb; }
-        .flash-info { background-color: #d1ecf1; color: #0c5460; border: 1px solid #bee5eb; }
-        .progress-container { display: none; margin-top: 20px; }
-        .progress-bar { width: 100%; background-color: #e9ecef; border-radius: 4px; }
-        .progress-bar-inner { width: 0%; height: 24px; background-color: #28a745; text-align: center; line-height: 24px; color: white; border-radius: 4px; transition: width 0.4s ease; }
-        #progress-log { margin-top: 10px; font-family: monospace; font-size: 12px; max-height: 200px; overflow-y: auto; background: #333; color: #fff; padding: 10px; border-radius: 4px; }
-        .notification { position: fixed; top: 20px; right: 20px; padding: 15px 20px; border-radius: 8px; color: white; font-weight: bold; z-index: 10000; animation: slideIn 0.3s ease-out; }
-        .notification.success { background-color: #28a745; }
-        .notification.error { background-color: #dc3545; }
-        .notification.info { background-color: #17a2b8; }
-        @keyframes slideIn { from { transform: translateX(100%); opacity: 0; } to { transform: translateX(0); opacity: 1; } }
-    </style>
+    <link rel="stylesheet" href="{{ static_url('app.css') }}">
 </head>
 <body>
 <div class="container">
     <h1>Video Downloader & Uploader</h1>
     <p>Powered by yt-dlp, FFmpeg & Pixeldrain</p>
-    {% with messages = get_flashed_messages(with_categories=true) %}
-        {% if messages %}
-            {% for category, message in messages %}
-                <div class="flash-msg flash-{{ category }}">{{ message|safe }}</div>
-            {% endfor %}
-        {% endif %}
-    {% endwith %}
+    {% include "_flashes.html" %}
 
-    <div id="progress-container" class="progress-container">
-        <h3 id="progress-stage">Starting...</h3>
-        <div class="progress-bar">
-            <div id="progress-bar-inner" class="progress-bar-inner">0%</div>
-        </div>
-        <pre id="progress-log"></pre>
-    </div>
+    {% include "_progress.html" %}
 
     <!-- MANUAL MERGE SECTION -->
     <hr>
@@ -145,7 +473,7 @@ TEMPLATE = """
             <label>Video Format:</label><br>
             <select name="video_id" required>
                 {% for format in video_formats %}
-                    <option value="{{ format.id }}" {% if format.is_muxed %}style="font-style: italic;"{% endif %}>{{ format.display }}{% if format.is_muxed %} (with audio){% endif %}</option>
+                    <option value="{{ format.id }}" {% if format.is_muxed %}style="font-style: italic;"{% endif %}>{{ video_label(format) }}{% if format.is_muxed %} (with audio){% endif %}</option>
                 {% endfor %}
             </select><br>
 
@@ -153,7 +481,7 @@ TEMPLATE = """
             <select name="audio_id">
                 <option value="">Best Audio (default)</option>
                 {% for format in audio_formats %}
-                    <option value="{{ format.id }}">{{ format.display }}</option>
+                    <option value="{{ format.id }}">{{ audio_label(format) }}</option>
                 {% endfor %}
             </select><br>
             
@@ -164,6 +492,9 @@ TEMPLATE = """
                 <option value="none" {% if codec == "none" %}selected{% endif %}>No Encoding</option>
                 <option value="h265" {% if codec == "h265" %}selected{% endif %}>Encode to H.265 (x265)</option>
                 <option value="av1" {% if codec == "av1" %}selected{% endif %}>Encode to AV1 (SVT-AV1)</option>
+                {% for value, label in hw_encoders().items() %}
+                    <option value="{{ value }}" {% if codec == value %}selected{% endif %}>Encode to {{ label }}</option>
+                {% endfor %}
             </select><br>
             <div id="encoding-options" style="display: {% if codec != 'none' %}block{% else %}none{% endif %};">
                 <label>Encoding Mode:</label><br>
@@ -193,88 +524,7 @@ TEMPLATE = """
 
                 <label><input type="checkbox" name="force_stereo" value="true"> Force Stereo (2-channel) Audio</label><br>
             </div>
-            <script>
-                const codecSelect = document.getElementById('codec');
-                const presetSelect = document.getElementById('preset');
-                const crfInput = document.getElementById('crf');
-                const passModeSelect = document.getElementById('pass_mode');
-                const bitrateInput = document.getElementById('bitrate');
-
-                function updatePresetOptions() {
-                    const codec = codecSelect.value;
-                    presetSelect.innerHTML = '';
-                    if (codec === 'av1') {
-                        for (let p = 0; p <= 13; p++) {
-                            let label = p.toString();
-                            if (p === 0) label += ' (slowest)';
-                            else if (p === 13) label += ' (fastest)';
-                            else if (p > 7) label += ' (fast)';
-                            else label += ' (medium)';
-                            const option = document.createElement('option');
-                            option.value = p;
-                            option.text = label;
-                            if (p === 6) option.selected = true;
-                            presetSelect.appendChild(option);
-                        }
-                        crfInput.value = crfInput.value || '35';
-                        crfInput.placeholder = 'e.g., 35 for AV1';
-                    } else if (codec === 'h265') {
-                        const presets = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow', 'placebo'];
-                        presets.forEach(p => {
-                            const option = document.createElement('option');
-                            option.value = p;
-                            option.text = p;
-                            if (p === 'faster') option.selected = true;
-                            presetSelect.appendChild(option);
-                        });
-                        crfInput.value = crfInput.value || '28';
-                        crfInput.placeholder = 'e.g., 28 for H.265';
-                    }
-                    const encodingOptions = document.getElementById('encoding-options');
-                    encodingOptions.style.display = codec !== 'none' ? 'block' : 'none';
-                    
-                    if (codec === 'none') {
-                        bitrateInput.removeAttribute('required');
-                        bitrateInput.removeAttribute('min');
-                        bitrateInput.value = '';
-                    } else {
-                        bitrateInput.setAttribute('min', '100');
-                        if (passModeSelect.value === '2-pass') {
-                            bitrateInput.setAttribute('required', 'required');
-                        } else {
-                            bitrateInput.removeAttribute('required');
-                        }
-                    }
-                }
-
-                function validateForm() {
-                    const codec = codecSelect.value;
-                    if (codec !== 'none') {
-                        if (!presetSelect.value) {
-                            alert('Please select a preset.');
-                            return false;
-                        }
-                        if (passModeSelect.value === '2-pass' && (!bitrateInput.value || parseInt(bitrateInput.value) < 100)) {
-                            alert('Please specify a valid video bitrate (minimum 100) for 2-pass encoding.');
-                            return false;
-                        }
-                    }
-                    return true;
-                }
-
-                codecSelect.addEventListener('change', updatePresetOptions);
-                passModeSelect.addEventListener('change', function() {
-                    if (codecSelect.value !== 'none') {
-                        if (this.value === '2-pass') {
-                            bitrateInput.setAttribute('required', 'required');
-                        } else {
-                            bitrateInput.removeAttribute('required');
-                        }
-                    }
-                });
-
-                document.addEventListener('DOMContentLoaded', updatePresetOptions);
-            </script>
+            <script src="{{ static_url('preset.js') }}" defer></script>
             <br>
             <label><input type="checkbox" name="upload_pixeldrain" value="true"> Upload to Pixeldrain after completion</label><br><br>
             <button type="submit" name="action" value="download">Download & Convert</button>
@@ -307,89 +557,8 @@ TEMPLATE = """
     <p><a href="{{ url_for('list_files') }}">📂 Manage Downloaded Files</a></p>
 </div>
 
-<script>
-    function showNotification(message, type = 'info') {
-        const notification = document.createElement('div');
-        notification.className = `notification ${type}`;
-        notification.textContent = message;
-        document.body.appendChild(notification);
-        
-        setTimeout(() => {
-            notification.style.opacity = '0';
-            setTimeout(() => {
-                document.body.removeChild(notification);
-            }, 300);
-        }, 3000);
-    }
-
-    document.addEventListener("DOMContentLoaded", function() {
-        {% if download_started %}
-            const progressContainer = document.getElementById('progress-container');
-            const stage = document.getElementById('progress-stage');
-            const progressBar = document.getElementById('progress-bar-inner');
-            const log = document.getElementById('progress-log');
-            
-            progressContainer.style.display = 'block';
-
-            const eventSource = new EventSource("{{ url_for('progress_stream') }}");
-            let finalUrl = null; // Variable to store the final URL from the upload
-            
-            eventSource.onmessage = function(event) {
-                try {
-                    const data = JSON.parse(event.data);
-                    
-                    if (data.final_url) {
-                        finalUrl = data.final_url;
-                    }
-                    
-                    if (data.log && data.log === 'DONE') {
-                        eventSource.close();
-                        stage.textContent = '✅ Completed!';
-                        progressBar.style.backgroundColor = '#28a745';
-                        log.innerHTML += "\\n\\nOperation finished. Redirecting...";
-                        
-                        let redirectTarget = "{{ url_for('list_files') }}";
-                        if (finalUrl) {
-                            redirectTarget = "{{ url_for('operation_complete') }}?url=" + encodeURIComponent(finalUrl);
-                        }
-                        
-                        setTimeout(() => { window.location.href = redirectTarget; }, 2000);
-                        return;
-                    }
-
-                    if (data.error) {
-                        eventSource.close();
-                        stage.textContent = '❌ Error!';
-                        progressBar.style.backgroundColor = '#dc3545';
-                        log.innerHTML += `\\n\\nERROR: ${data.error}`;
-                        showNotification('Operation failed: ' + data.error, 'error');
-                        return;
-                    }
-
-                    if (data.stage) {
-                        stage.textContent = data.stage;
-                    }
-                    if (data.percent) {
-                        progressBar.style.width = data.percent + '%';
-                        progressBar.textContent = data.percent.toFixed(1) + '%';
-                    }
-                    if (data.log) {
-                        log.innerHTML += data.log + '\\n';
-                        log.scrollTop = log.scrollHeight;
-                    }
-                } catch (e) {
-                    console.error('Error parsing SSE data:', e);
-                }
-            };
-
-            eventSource.onerror = function(err) {
-                stage.textContent = 'Connection error. Please refresh.';
-                eventSource.close();
-                console.error('SSE error:', err);
-            };
-        {% endif %}
-    });
-</script>
+<script src="{{ static_url('app.js') }}" defer></script>
+{% include "_watch_progress.html" %}
 </body>
 </html>
 """
@@ -400,45 +569,16 @@ ENCODE_TEMPLATE = """
 <head>
     <meta charset="UTF-8">
     <title>Encode Video</title>
-    <style>
-        body { font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Helvetica, Arial, sans-serif; line-height: 1.6; background-color: #f4f4f9; color: #333; margin: 0; padding: 20px; }
-        .container { max-width: 800px; margin: auto; background: #fff; padding: 20px; border-radius: 8px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }
-        h1, h2, h3 { color: #444; }
-        hr { border: 0; border-top: 1px solid #ddd; margin: 20px 0; }
-        input[type="text"], input[type="number"], select { width: 100%; padding: 8px; margin: 5px 0 15px; border: 1px solid #ccc; border-radius: 4px; box-sizing: border-box; }
-        button { background-color: #007bff; color: white; padding: 10px 15px; border: none; border-radius: 4px; cursor: pointer; font-size: 16px; }
-        button:hover { background-color: #0056b3; }
-        a { color: #007bff; text-decoration: none; }
-        a:hover { text-decoration: underline; }
-        .flash-msg { padding: 10px; border-radius: 4px; margin-bottom: 15px; }
-        .flash-success { background-color: #d4edda; color: #155724; border: 1px solid #c3e6cb; }
-        .flash-error { background-color: #f8d7da; color: #721c24; border: 1px solid #f5c6cb; }
-        .progress-container { display: none; margin-top: 20px; }
-        .progress-bar { width: 100%; background-color: #e9ecef; border-radius: 4px; }
-        .progress-bar-inner { width: 0%; height: 24px; background-color: #28a745; text-align: center; line-height: 24px; color: white; border-radius: 4px; transition: width 0.4s ease; }
-        #progress-log { margin-top: 10px; font-family: monospace; font-size: 12px; max-height: 200px; overflow-y: auto; background: #333; color: #fff; padding: 10px; border-radius: 4px; }
-    </style>
+    <link rel="stylesheet" href="{{ static_url('app.css') }}">
 </head>
 <body>
 <div class="container">
     <h1>Encode Video: {{ filepath }}</h1>
-    {% with messages = get_flashed_messages(with_categories=true) %}
-        {% if messages %}
-            {% for category, message in messages %}
-                <div class="flash-msg flash-{{ category }}">{{ message|safe }}</div>
-            {% endfor %}
-        {% endif %}
-    {% endwith %}
+    {% include "_flashes.html" %}
 
-    <div id="progress-container" class="progress-container">
-        <h3 id="progress-stage">Starting...</h3>
-        <div class="progress-bar">
-            <div id="progress-bar-inner" class="progress-bar-inner">0%</div>
-        </div>
-        <pre id="progress-log"></pre>
-    </div>
+    {% include "_progress.html" %}
 
-    <form method="POST" onsubmit="return validateEncodeForm()">
+    <form method="POST" onsubmit="return validateForm()">
         <label>Output Filename (relative to downloads folder):</label><br>
         <input type="text" name="output_filename" value="{{ suggested_output }}" required><br>
         
@@ -447,6 +587,9 @@ ENCODE_TEMPLATE = """
             <option value="none" {% if codec == "none" %}selected{% endif %}>No Encoding (Copy)</option>
             <option value="h265" {% if codec == "h265" %}selected{% endif %}>Encode to H.265 (x265)</option>
             <option value="av1" {% if codec == "av1" %}selected{% endif %}>Encode to AV1 (SVT-AV1)</option>
+            {% for value, label in hw_encoders().items() %}
+                <option value="{{ value }}" {% if codec == value %}selected{% endif %}>Encode to {{ label }}</option>
+            {% endfor %}
         </select><br>
         
         <div id="encoding-options" style="display: {% if codec != 'none' %}block{% else %}none{% endif %};">
@@ -478,88 +621,7 @@ ENCODE_TEMPLATE = """
             <label><input type="checkbox" name="force_stereo" value="true"> Force Stereo (2-channel) Audio</label><br>
         </div>
         
-        <script>
-            const codecSelect = document.getElementById('codec');
-            const presetSelect = document.getElementById('preset');
-            const crfInput = document.getElementById('crf');
-            const passModeSelect = document.getElementById('pass_mode');
-            const bitrateInput = document.getElementById('bitrate');
-
-            function updatePresetOptions() {
-                const codec = codecSelect.value;
-                presetSelect.innerHTML = '';
-                if (codec === 'av1') {
-                    for (let p = 0; p <= 13; p++) {
-                        let label = p.toString();
-                        if (p === 0) label += ' (slowest)';
-                        else if (p === 13) label += ' (fastest)';
-                        else if (p > 7) label += ' (fast)';
-                        else label += ' (medium)';
-                        const option = document.createElement('option');
-                        option.value = p;
-                        option.text = label;
-                        if (p === 6) option.selected = true;
-                        presetSelect.appendChild(option);
-                    }
-                    crfInput.value = crfInput.value || '35';
-                    crfInput.placeholder = 'e.g., 35 for AV1';
-                } else if (codec === 'h265') {
-                    const presets = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow', 'placebo'];
-                    presets.forEach(p => {
-                        const option = document.createElement('option');
-                        option.value = p;
-                        option.text = p;
-                        if (p === 'faster') option.selected = true;
-                        presetSelect.appendChild(option);
-                    });
-                    crfInput.value = crfInput.value || '28';
-                    crfInput.placeholder = 'e.g., 28 for H.265';
-                }
-                const encodingOptions = document.getElementById('encoding-options');
-                encodingOptions.style.display = codec !== 'none' ? 'block' : 'none';
-                
-                if (codec === 'none') {
-                    bitrateInput.removeAttribute('required');
-                    bitrateInput.removeAttribute('min');
-                    bitrateInput.value = '';
-                } else {
-                    bitrateInput.setAttribute('min', '100');
-                    if (passModeSelect.value === '2-pass') {
-                        bitrateInput.setAttribute('required', 'required');
-                    } else {
-                        bitrateInput.removeAttribute('required');
-                    }
-                }
-            }
-
-            function validateEncodeForm() {
-                const codec = codecSelect.value;
-                if (codec !== 'none') {
-                    if (!presetSelect.value) {
-                        alert('Please select a preset.');
-                        return false;
-                    }
-                    if (passModeSelect.value === '2-pass' && (!bitrateInput.value || parseInt(bitrateInput.value) < 100)) {
-                        alert('Please specify a valid video bitrate (minimum 100) for 2-pass encoding.');
-                        return false;
-                    }
-                }
-                return true;
-            }
-
-            codecSelect.addEventListener('change', updatePresetOptions);
-            passModeSelect.addEventListener('change', function() {
-                if (codecSelect.value !== 'none') {
-                    if (this.value === '2-pass') {
-                        bitrateInput.setAttribute('required', 'required');
-                    } else {
-                        bitrateInput.removeAttribute('required');
-                    }
-                }
-            });
-
-            document.addEventListener('DOMContentLoaded', updatePresetOptions);
-        </script>
+        <script src="{{ static_url('preset.js') }}" defer></script>
         
         <br>
         <label><input type="checkbox" name="upload_pixeldrain" value="true"> Upload to Pixeldrain after completion</label><br><br>
@@ -568,74 +630,8 @@ ENCODE_TEMPLATE = """
     </form>
 </div>
 
-<script>
-    document.addEventListener("DOMContentLoaded", function() {
-        {% if download_started %}
-            const progressContainer = document.getElementById('progress-container');
-            const stage = document.getElementById('progress-stage');
-            const progressBar = document.getElementById('progress-bar-inner');
-            const log = document.getElementById('progress-log');
-            
-            progressContainer.style.display = 'block';
-
-            const eventSource = new EventSource("{{ url_for('progress_stream') }}");
-            let finalUrl = null; // Variable to store the final URL
-            
-            eventSource.onmessage = function(event) {
-                try {
-                    const data = JSON.parse(event.data);
-                    
-                    if (data.final_url) {
-                        finalUrl = data.final_url;
-                    }
-
-                    if (data.log && data.log === 'DONE') {
-                        eventSource.close();
-                        stage.textContent = '✅ Completed!';
-                        progressBar.style.backgroundColor = '#28a745';
-                        log.innerHTML += "\\n\\nOperation finished. Redirecting...";
-                        
-                        let redirectTarget = "{{ url_for('list_files') }}";
-                        if (finalUrl) {
-                            redirectTarget = "{{ url_for('operation_complete') }}?url=" + encodeURIComponent(finalUrl);
-                        }
-                        
-                        setTimeout(() => { window.location.href = redirectTarget; }, 2000);
-                        return;
-                    }
-
-                    if (data.error) {
-                        eventSource.close();
-                        stage.textContent = '❌ Error!';
-                        progressBar.style.backgroundColor = '#dc3545';
-                        log.innerHTML += `\\n\\nERROR: ${data.error}`;
-                        return;
-                    }
-
-                    if (data.stage) {
-                        stage.textContent = data.stage;
-                    }
-                    if (data.percent) {
-                        progressBar.style.width = data.percent + '%';
-                        progressBar.textContent = data.percent.toFixed(1) + '%';
-                    }
-                    if (data.log) {
-                        log.innerHTML += data.log + '\\n';
-                        log.scrollTop = log.scrollHeight;
-                    }
-                } catch (e) {
-                    console.error('Error parsing SSE data:', e);
-                }
-            };
-
-            eventSource.onerror = function(err) {
-                stage.textContent = 'Connection error. Please refresh.';
-                eventSource.close();
-                console.error('SSE error:', err);
-            };
-        {% endif %}
-    });
-</script>
+<script src="{{ static_url('app.js') }}" defer></script>
+{% include "_watch_progress.html" %}
 </body>
 </html>
 """
@@ -646,168 +642,225 @@ FILE_OPERATION_TEMPLATE = """
 <head>
     <meta charset="UTF-8">
     <title>Processing...</title>
-    <style>
-        body { font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Helvetica, Arial, sans-serif; line-height: 1.6; background-color: #f4f4f9; color: #333; margin: 0; padding: 20px; }
-        .container { max-width: 800px; margin: auto; background: #fff; padding: 20px; border-radius: 8px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); }
-        h1, h2, h3 { color: #444; }
-        pre { background-color: #eee; padding: 10px; border-radius: 4px; white-space: pre-wrap; word-wrap: break-word; }
-        .progress-container { display: block; margin-top: 20px; }
-        .progress-bar { width: 100%; background-color: #e9ecef; border-radius: 4px; }
-        .progress-bar-inner { width: 0%; height: 24px; background-color: #17a2b8; text-align: center; line-height: 24px; color: white; border-radius: 4px; transition: width 0.4s ease; }
-        #progress-log { margin-top: 10px; font-family: monospace; font-size: 12px; max-height: 200px; overflow-y: auto; background: #333; color: #fff; padding: 10px; border-radius: 4px; }
-    </style>
+    <link rel="stylesheet" href="{{ static_url('app.css') }}">
 </head>
 <body>
 <div class="container">
     <h1>{{ operation_title }}</h1>
     <p>Please wait while the operation completes. You will be redirected automatically.</p>
-    <div id="progress-container" class="progress-container">
-        <h3 id="progress-stage">Starting...</h3>
-        <div class="progress-bar">
-            <div id="progress-bar-inner" class="progress-bar-inner" style="background-color: #17a2b8;">0%</div>
-        </div>
-        <pre id="progress-log"></pre>
-    </div>
+    {% set progress_bar_color = '#17a2b8' %}
+    {% include "_progress.html" %}
 </div>
 
-<script>
-    document.addEventListener("DOMContentLoaded", function() {
-        {% if download_started %}
-            const stage = document.getElementById('progress-stage');
-            const progressBar = document.getElementById('progress-bar-inner');
-            const log = document.getElementById('progress-log');
-            
-            const eventSource = new EventSource("{{ url_for('progress_stream') }}");
-            let finalUrl = null;
-            
-            eventSource.onmessage = function(event) {
-                try {
-                    const data = JSON.parse(event.data);
-                    if (data.final_url) finalUrl = data.final_url;
-                    if (data.log && data.log === 'DONE') {
-                        eventSource.close();
-                        stage.textContent = '✅ Completed!';
-                        progressBar.style.backgroundColor = '#28a745';
-                        log.innerHTML += "\\n\\nOperation finished. Redirecting...";
-                        let redirectTarget = "{{ url_for('list_files') }}";
-                        if (finalUrl) redirectTarget = "{{ url_for('operation_complete') }}?url=" + encodeURIComponent(finalUrl);
-                        setTimeout(() => { window.location.href = redirectTarget; }, 2000);
-                        return;
-                    }
-                    if (data.error) {
-                        eventSource.close();
-                        stage.textContent = '❌ Error!';
-                        progressBar.style.backgroundColor = '#dc3545';
-                        log.innerHTML += `\\n\\nERROR: ${data.error}`;
-                        return;
-                    }
-                    if (data.stage) stage.textContent = data.stage;
-                    if (data.percent) {
-                        progressBar.style.width = data.percent + '%';
-                        progressBar.textContent = data.percent.toFixed(1) + '%';
-                    }
-                    if (data.log) {
-                        log.innerHTML += data.log + '\\n';
-                        log.scrollTop = log.scrollHeight;
-                    }
-                } catch (e) {
-                    console.error('Error parsing SSE data:', e);
-                }
-            };
-            eventSource.onerror = function(err) {
-                stage.textContent = 'Connection error. Please refresh.';
-                eventSource.close();
-                console.error('SSE error:', err);
-            };
-        {% endif %}
-    });
-</script>
+<script src="{{ static_url('app.js') }}" defer></script>
+{% include "_watch_progress.html" %}
 </body>
 </html>
 """
 
+FILES_TEMPLATE = """
+<!DOCTYPE html><html><head><title>Downloaded Files</title>
+<link rel="stylesheet" href="{{ static_url('listing.css') }}">
+</head><body>
+<div class="container">
+    <h1>Files in {{ folder_name }}</h1>
+    {% include "_flashes.html" %}
+    {% if parent_url %}<p><a href="{{ parent_url }}">⬆️ Up</a></p>{% endif %}
+    <h3>Upload a file from your computer to the server</h3>
+    <form method="POST" action="{{ url_for('upload_local') }}" enctype="multipart/form-data" style="margin-bottom:20px;">
+        <input type="file" name="file" required>
+        <button type="submit" class="upload">Upload to Server</button>
+    </form>
+    {% if items %}
+        <table><thead><tr><th>Name</th><th>Size</th><th>Modified</th><th>Actions</th></tr></thead><tbody>
+        {% for item in items %}
+        <tr>
+            <td>{{ item.display_path }}</td>
+            <td>{{ item.size }}</td>
+            <td>{{ item.modified }}</td>
+            <td class="actions">
+                {% if item.is_dir %}
+                    <a href="{{ item.open_url }}">Open</a>
+                    <form method="POST" action="{{ item.upload_url }}" style="display:inline;">
+                        <button type="submit" class="upload">Upload to Pixeldrain</button>
+                    </form>
+                {% else %}
+                    <a href="{{ item.download_url }}">Download</a>
+                    <a href="{{ item.encode_url }}" class="encode">Encode</a>
+                    <form method="POST" action="{{ item.delete_url }}" style="display:inline;">
+                        <button type="submit" class="delete" onclick="return confirm({{ item.delete_prompt }})">Delete</button>
+                    </form>
+                {% endif %}
+            </td>
+        </tr>
+        {% endfor %}
+        </tbody></table>
+    {% else %}
+        <p>No files downloaded yet.</p>
+    {% endif %}
+    <br><a href="{{ url_for('index') }}">🏠 Back to Main Page</a>
+</div>
+</body></html>
+"""
+
+def timestamp_to_datetime(s):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(s))
+
+def minify_template(source):
+    """Drops indentation and blank lines. Line breaks stay, so inline JS keeps working.
+
+    Safe for these templates: none has a literal multi-line <pre> or <textarea>.
+    """
+    return "\n".join(line.strip() for line in source.splitlines() if line.strip())
+
+# Partials are minified like the pages and served from memory; Flask's own
+# templates/ folder is still searched after them.
+app.jinja_loader = ChoiceLoader([
+    DictLoader({name: minify_template(source) for name, source in PARTIAL_TEMPLATES.items()}),
+    app.jinja_loader,
+])
+
+# Compile once at import; render_template_string re-parses the source on every call.
+COMPILED_TEMPLATE = app.jinja_env.from_string(minify_template(TEMPLATE))
+COMPILED_ENCODE_TEMPLATE = app.jinja_env.from_string(minify_template(ENCODE_TEMPLATE))
+COMPILED_FILE_OPERATION_TEMPLATE = app.jinja_env.from_string(minify_template(FILE_OPERATION_TEMPLATE))
+COMPILED_FILES_TEMPLATE = app.jinja_env.from_string(minify_template(FILES_TEMPLATE))
+
 # -----------------------------
 # Helper Functions
 # -----------------------------
+_SIZE_UNITS = ('B', 'KiB', 'MiB', 'GiB', 'TiB')
+
+@app.template_filter('human_size')
 def human_size(size_bytes):
-    if size_bytes is None or size_bytes == 0:
+    if not size_bytes:
         return "0 B"
-    power = 1024
-    n = 0
-    power_labels = {0: '', 1: 'K', 2: 'M', 3: 'G', 4: 'T'}
-    while size_bytes >= power and n < len(power_labels) -1 :
-        size_bytes /= power
-        n += 1
-    return f"{size_bytes:.1f} {power_labels[n]}iB"
+    # Each unit is 2**10 of the previous one, so the bit length picks it directly.
+    # Clamped at 0 for fractional sizes (yt-dlp's filesize_approx can be a float).
+    n = max(0, min(len(_SIZE_UNITS) - 1, (int(size_bytes).bit_length() - 1) // 10))
+    return f"{size_bytes / (1 << (10 * n)):.1f} {_SIZE_UNITS[n]}"
+
+_UNSAFE_FILENAME_RE = re.compile(r'[\\/*?:"<>|]')
+_WHITESPACE_RE = re.compile(r'\s+')
+MAX_FILENAME_BYTES = 200
+
+def _clip_filename(part):
+    """Truncates a path component to MAX_FILENAME_BYTES of UTF-8, keeping its extension."""
+    if len(part.encode('utf-8')) <= MAX_FILENAME_BYTES:
+        return part
+    stem, ext = os.path.splitext(part)
+    budget = max(1, MAX_FILENAME_BYTES - len(ext.encode('utf-8')))
+    return stem.encode('utf-8')[:budget].decode('utf-8', 'ignore').rstrip() + ext
 
 def get_safe_filename(name):
     """Sanitizes a string to be a valid filename component, allowing slashes for paths."""
-    parts = name.split('/')
-    safe_parts = [re.sub(r'[\\/*?:"<>|]', "_", part) for part in parts]
-    safe_parts = [re.sub(r'\s+', ' ', part).strip() for part in safe_parts]
-    return '/'.join(safe_parts)
-
-def get_file_size(file_path):
-    try:
-        return human_size(os.path.getsize(file_path))
-    except FileNotFoundError:
-        return "N/A"
+    safe_parts = []
+    for part in name.split('/'):
+        part = _WHITESPACE_RE.sub(' ', _UNSAFE_FILENAME_RE.sub('_', part)).strip()
+        # Dropping "." and ".." keeps the result inside DOWNLOAD_FOLDER.
+        if part and part not in ('.', '..'):
+            safe_parts.append(_clip_filename(part))
+    return '/'.join(safe_parts) or 'file'
+
+_VIDEO_EXTS = frozenset({'.mp4', '.avi', '.mov', '.mkv', '.wmv', '.flv', '.webm', '.m4v', '.3gp', '.mpg', '.mpeg', '.ts', '.vob'})
+_AUDIO_EXTS = frozenset({'.mp3', '.wav', '.flac', '.aac', '.ogg', '.wma', '.m4a', '.opus'})
+_MEDIA_EXTS = _VIDEO_EXTS | _AUDIO_EXTS
 
 def is_media_file(file_path):
-    video_extensions = {'.mp4', '.avi', '.mov', '.mkv', '.wmv', '.flv', '.webm', '.m4v', '.3gp', '.mpg', '.mpeg', '.ts', '.vob'}
-    audio_extensions = {'.mp3', '.wav', '.flac', '.aac', '.ogg', '.wma', '.m4a', '.opus'}
-    ext = os.path.splitext(os.path.basename(file_path))[1].lower()
-    return ext in video_extensions or ext in audio_extensions
-
-def get_media_info(file_path):
-    try:
-        command = [
-            "ffprobe", "-v", "quiet", "-print_format", "json",
-            "-show_streams", "-show_format", file_path
-        ]
-        result = subprocess.check_output(command, stderr=subprocess.STDOUT)
-        data = json.loads(result)
-        info = {}
-        video_stream = next((s for s in data.get('streams', []) if s.get('codec_type') == 'video'), None)
-        audio_stream = next((s for s in data.get('streams', []) if s.get('codec_type') == 'audio'), None)
-        if video_stream:
-            info['video_codec'] = video_stream.get('codec_name', 'N/A')
-            fr_str = video_stream.get('avg_frame_rate', '0/1')
-            if '/' in fr_str and fr_str != '0/1':
-                num, den = map(int, fr_str.split('/'))
-                info['video_fps'] = f"{num / den:.2f}" if den else '0.00'
-            else:
-                info['video_fps'] = 'N/A'
-            v_br = video_stream.get('bit_rate')
-            if not v_br and 'format' in data: v_br = data['format'].get('bit_rate')
-            info['video_bitrate'] = f"{int(v_br) // 1000} kbps" if v_br else 'N/A'
-        if audio_stream:
-            info['audio_codec'] = audio_stream.get('codec_name', 'N/A')
-            a_br = audio_stream.get('bit_rate')
-            info['audio_bitrate'] = f"{int(a_br) // 1000} kbps" if a_br else 'N/A'
-        return info
-    except Exception as e:
-        return {"error": "Could not retrieve media information."}
-
-def fetch_formats(url):
-    try:
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-            'skip_download': True,
-            'format': 'best',
-        }
+    return os.path.splitext(file_path)[1].lower() in _MEDIA_EXTS
+
+# yt-dlp extraction (webpage + player download) dominates fetch/download latency,
+# and a fetch is usually followed by a download of the same URL. Keep results for
+# INFO_CACHE_TTL seconds, or until the signed format URLs inside them expire.
+INFO_CACHE_TTL = 600
+INFO_CACHE_MAX = 64
+_INFO_CACHE = {}
+_INFO_CACHE_LOCK = threading.Lock()
+_TRACKING_PARAMS = {'si', 'feature', 'pp', 'fbclid', 'gclid', 'igshid'}
+_EXPIRE_RE = re.compile(r'[?&/]expire[=/](\d+)')
+
+def normalize_url(url):
+    """Strips tracking parameters so share links and plain links hit the same cache entry."""
+    parts = urlsplit(url.strip())
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+             if k not in _TRACKING_PARAMS and not k.startswith('utm_')]
+    return urlunsplit(parts._replace(query=urlencode(query), fragment=''))
+
+def _info_ttl(info):
+    """Seconds an info dict stays usable: the cache TTL, cut short by the earliest format expiry."""
+    ttl = INFO_CACHE_TTL
+    for f in info.get('formats') or []:
+        match = _EXPIRE_RE.search(f.get('url') or '')
+        if match:
+            # Leave a minute of slack so a download never starts on a dying URL.
+            ttl = min(ttl, int(match.group(1)) - time.time() - 60)
+    return ttl
+
+# Idle extraction-only YoutubeDL instances. Building one loads every extractor
+# class and a cookie jar, and a warm one keeps deciphered player code in memory.
+# YoutubeDL isn't thread-safe, so each instance serves one request at a time.
+_EXTRACTORS = []
+_EXTRACTORS_LOCK = threading.Lock()
+
+@contextmanager
+def pooled_extractor():
+    with _EXTRACTORS_LOCK:
+        ydl = _EXTRACTORS.pop() if _EXTRACTORS else None
+    if ydl is None:
+        ydl_opts = {'quiet': True, 'no_warnings': True, 'cachedir': YT_DLP_CACHE_DIR}
         if os.path.exists(COOKIES_FILE):
             ydl_opts['cookiefile'] = COOKIES_FILE
+        ydl = yt_dlp.YoutubeDL(ydl_opts)
+    try:
+        yield ydl
+    finally:
+        with _EXTRACTORS_LOCK:
+            _EXTRACTORS.append(ydl)
+
+def get_info(url, refresh=False):
+    """Returns yt-dlp's info dict for url, reusing a recent extraction unless refresh is set.
+
+    The returned dict is shared; copy it before handing it to anything that mutates it.
+    """
+    key = normalize_url(url)
+    now = time.monotonic()
+    if not refresh:
+        with _INFO_CACHE_LOCK:
+            entry = _INFO_CACHE.get(key)
+        if entry and entry[0] > now:
+            return entry[1]
+
+    with pooled_extractor() as ydl:
+        info = ydl.extract_info(url, download=False)
+
+    ttl = _info_ttl(info)
+    with _INFO_CACHE_LOCK:
+        for k in [k for k, (expires, _) in _INFO_CACHE.items() if expires <= now]:
+            del _INFO_CACHE[k]
+        while len(_INFO_CACHE) >= INFO_CACHE_MAX:
+            del _INFO_CACHE[next(iter(_INFO_CACHE))]
+        if ttl > 0:
+            _INFO_CACHE[key] = (now + ttl, info)
+    return info
+
+def info_formats(info):
+    """Returns the formats of a yt-dlp info dict, or of its first entry for playlists."""
+    formats = info.get('formats') or []
+    if not formats and 'entries' in info:
+        first = next((e for e in info['entries'] if e), {})
+        formats = first.get('formats') or []
+    return formats
+
+def is_muxed_format(f):
+    """True for a format that carries both video and audio."""
+    return f.get('vcodec', 'none') != 'none' and f.get('acodec', 'none') != 'none'
+
+def fetch_formats(url, refresh=False):
+    """Returns (raw listing, video formats, audio formats, filename stem) for url."""
+    try:
+        info = get_info(url, refresh)
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-
-        formats = info.get('formats', []) or []
-        if not formats and 'entries' in info:
-            first = next((e for e in info['entries'] if e), {})
-            formats = first.get('formats', []) or []
+        formats = info_formats(info)
 
         video_formats = []
         audio_formats = []
@@ -821,103 +874,516 @@ def fetch_formats(url):
             vcodec = f.get('vcodec', 'none')
             filesize = f.get('filesize') or f.get('filesize_approx') or 0
             size = human_size(filesize) if filesize else "Unknown"
-            abr = f.get('abr', 0)
-            vbr = f.get('tbr', 0) or f.get('vbr', 0)
+            abr = f.get('abr') or 0
+            vbr = f.get('tbr') or f.get('vbr') or 0
 
             raw_lines.append(f"{fid}: {vcodec} | {acodec} | {height}p | {fps}fps | {size}")
 
             is_video_only = vcodec != 'none' and acodec == 'none'
-            is_muxed = vcodec != 'none' and acodec != 'none'
+            is_muxed = is_muxed_format(f)
             is_audio_only = vcodec == 'none' and acodec != 'none'
 
-            if is_video_only:
+            # Option labels are rendered by TEMPLATE's video_label/audio_label macros.
+            if is_video_only or is_muxed:
                 video_formats.append({
-                    'id': fid, 'display': f"{height}p {fps}fps {vcodec.upper()} ~{int(vbr)}k ({size})",
-                    'h': height, 'fps': fps, 'is_muxed': False
-                })
-            elif is_muxed:
-                video_formats.append({
-                    'id': fid, 'display': f"{height}p {fps}fps {vcodec.upper()}+{acodec.upper()} ({size})",
-                    'h': height, 'fps': fps, 'is_muxed': True
+                    'id': fid, 'h': height, 'fps': fps, 'vcodec': vcodec, 'acodec': acodec,
+                    'size': filesize, 'vbr': vbr, 'is_muxed': is_muxed
                 })
             elif is_audio_only:
-                audio_formats.append({
-                    'id': fid, 'display': f"{acodec.upper()} {int(abr)}kbps ({size})",
-                    'br': abr
-                })
+                audio_formats.append({'id': fid, 'acodec': acodec, 'size': filesize, 'br': abr})
 
-        video_formats.sort(key=lambda x: (x.get('h', 0), x.get('fps', 0)), reverse=True)
-        audio_formats.sort(key=lambda x: x.get('br', 0), reverse=True)
-        return '\n'.join(raw_lines), video_formats, audio_formats
+        video_formats.sort(key=lambda x: (x['h'], x['fps']), reverse=True)
+        audio_formats.sort(key=lambda x: x['br'], reverse=True)
+        return '\n'.join(raw_lines), video_formats, audio_formats, safe_title(info.get('title'))
     except Exception as e:
         error_msg = str(e)
         if "videoModel" in error_msg or "Private video" in error_msg or "unavailable" in error_msg:
             flash("This video may be private, age-restricted, or region-blocked. Try logging in with cookies.", "error")
         else:
             flash(f"Format fetch failed: {error_msg}", "error")
-        return "", [], []
-
-def get_original_filename(url):
+        return "", [], [], ""
+
+# Plain yt-dlp format ids ("137", "251-drc", "hls-1080p", "dash-video=123000").
+# Anything else would be read as format-selection syntax, not an id.
+_FORMAT_ID_RE = re.compile(r'[A-Za-z0-9_.=-]{1,64}')
+
+def check_format_id(format_id):
+    """Returns format_id unchanged, or raises ValueError if it is not a plain format id."""
+    if not format_id or not _FORMAT_ID_RE.fullmatch(format_id):
+        raise ValueError(f"Invalid format ID: {format_id!r}")
+    return format_id
+
+def ensure_free_space(info, folder=DOWNLOAD_FOLDER):
+    """Raises if the formats selected in a yt-dlp info dict clearly won't fit on disk."""
+    formats = info.get('requested_formats') or [info]
+    needed = sum(f.get('filesize') or f.get('filesize_approx') or 0 for f in formats)
+    # Merging keeps the separate streams on disk until the merged file is written.
+    if len(formats) > 1:
+        needed *= 2
+    free = shutil.disk_usage(folder).free
+    if needed and needed * 1.1 > free:
+        raise RuntimeError(f"Not enough disk space: needs about {human_size(needed)}, only {human_size(free)} free.")
+
+# Top-level keys yt-dlp's format selection writes into an info dict, on top of the
+# chosen format's own fields; a merged pair also brings requested_formats.
+_SELECTION_KEYS = frozenset({
+    'requested_formats', 'requested_downloads', 'requested_subtitles', 'format', 'format_id',
+    'format_note', 'url', 'ext', 'protocol', 'filesize', 'filesize_approx', 'tbr', 'vbr', 'abr',
+})
+_EXTRACTION_KEYS = frozenset({'id', 'title', 'duration', 'formats', 'entries'})
+
+def unselected_info(info):
+    """Returns a deep copy of a processed yt-dlp info dict with its format selection undone.
+
+    get_info's dict has been through the default selection, which merged the chosen
+    format into the top level. Re-selecting overwrites only the new format's keys,
+    so a stale requested_formats would still download the old video+audio pair.
+    """
+    info = copy.deepcopy(info)
+    for item in (info, *(e for e in info.get('entries') or () if e)):
+        stale = set(_SELECTION_KEYS)
+        for f in item.get('formats') or ():
+            stale.update(f)
+        for key in stale - _EXTRACTION_KEYS:
+            item.pop(key, None)
+    return info
+
+def download_info(ydl, info):
+    """Downloads ydl's format selection from a cached info dict, after checking it fits on disk."""
+    ensure_free_space(ydl.process_ie_result(unselected_info(info), download=False))
+    ydl.process_ie_result(unselected_info(info), download=True)
+
+def safe_title(title):
+    """Turns a video title into a filename stem, replacing characters filesystems reject."""
+    return _UNSAFE_FILENAME_RE.sub("_", (title or 'download').strip())
+
+PIPE_BUFFER_SIZE = 1024 * 1024
+
+def enlarge_pipe(pipe):
+    """Grows a child's stdout pipe from the 64 KiB default so chatty tools don't block on us."""
+    if fcntl is None:
+        return
     try:
-        ydl_opts = {'quiet': True}
-        if os.path.exists(COOKIES_FILE):
-            ydl_opts['cookiefile'] = COOKIES_FILE
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-        title = info.get('title', 'download').strip()
-        safe_title = re.sub(r'[\\/*?:"<>|]', "_", title)
-        return f"{safe_title}.mkv"
-    except Exception:
-        return "download.mkv"
-
-def run_command_with_progress(command, stage, q):
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, encoding='utf-8', errors='ignore')
-    for line in iter(process.stdout.readline, ''):
-        q.put({"log": line.strip()})
-        match = re.search(r'\[download\]\s+([0-9.]+)%', line)
-        if match:
-            q.put({"stage": stage, "percent": float(match.group(1))})
+        fcntl.fcntl(pipe.fileno(), getattr(fcntl, 'F_SETPIPE_SZ', 1031), PIPE_BUFFER_SIZE)
+    except OSError:
+        pass  # above /proc/sys/fs/pipe-max-size; keep the default
+
+PIPE_READ_SIZE = 64 * 1024
+_LINE_BREAK = re.compile(rb'[\r\n]')
+
+def pipe_lines(pipe):
+    """Yields a binary pipe's non-empty lines as text, reading up to 64 KiB per syscall.
+
+    Splits on "\r" as well as "\n", so progress bars that redraw with a carriage
+    return come out as separate lines instead of one ever-growing one.
+    """
+    fd = pipe.fileno()
+    buf = b''
+    while chunk := os.read(fd, PIPE_READ_SIZE):
+        *lines, buf = _LINE_BREAK.split(buf + chunk)
+        for line in lines:
+            if line:
+                yield line.decode('utf-8', 'ignore')
+    if buf:
+        yield buf.decode('utf-8', 'ignore')
+
+WRITE_CHUNK_SIZE = 1024 * 1024
+# Marks in-progress outputs; list_files hides them.
+PARTIAL_PREFIX = ".partial-"
+# yt-dlp's in-flight download and resume-state files.
+PART_SUFFIXES = (".part", ".ytdl")
+
+def is_hidden_name(name):
+    """Dotfiles and unfinished downloads, which the listing skips unless asked."""
+    return name.startswith(".") or name.endswith(PART_SUFFIXES)
+
+def preallocate(f, size):
+    """Reserves size bytes for f up front so the file isn't grown extent by extent."""
+    if size <= 0 or not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError:
+        pass  # unsupported filesystem or not enough room; let the writes fail naturally
+
+def drop_page_cache(*paths):
+    """Advises the kernel to evict these files' pages once a job is finished with them.
+
+    Downloads and encodes are read about once more at most, so leaving gigabytes of
+    them cached would only push hotter data (code, listings, other jobs) out.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+def kill_if_cancelled(process, q):
+    """Kills a running child and raises JobCancelled once its job has been cancelled."""
+    if q.cancelled.is_set():
+        process.kill()
+        process.wait()
+        q.check_cancelled()
+
+class ProgressThrottle:
+    """Drops percent updates that are both too soon (<0.1s) and too small (<0.5%) after the last one.
+
+    Stage changes and the final 100% always go through, so the last state is never lost.
+    Dropped updates still refresh the channel's `progress` for /status.
+    """
+    def __init__(self, q, min_interval=0.1, min_step=0.5):
+        self.q = q
+        self.min_interval = min_interval
+        self.min_step = min_step
+        self.stage = None
+        self.last_percent = -1.0
+        self.last_time = 0.0
+
+    def update(self, stage, percent):
+        now = time.monotonic()
+        if (stage != self.stage or percent >= 100
+                or percent - self.last_percent >= self.min_step
+                or now - self.last_time >= self.min_interval):
+            self.stage, self.last_percent, self.last_time = stage, percent, now
+            self.q.put({"stage": stage, "percent": percent})
+        else:
+            self.q.progress = (stage, percent)
+
+# yt-dlp's merger already stream-copies ("-c copy"); these flags regenerate missing
+# input timestamps and shift negative ones to zero, which avoids slow or broken
+# muxes on some format pairs. Keys are yt-dlp's "<postprocessor>+<exe>_<i|o>" form.
+YT_DLP_MERGER_ARGS = {
+    'merger+ffmpeg_i': ['-fflags', '+genpts'],
+    'merger+ffmpeg_o': ['-avoid_negative_ts', 'make_zero'],
+}
+
+class LogBatcher:
+    """Coalesces log lines into one {"log": ...} message per burst.
+
+    A line arriving after a quiet spell goes out at once; lines in a burst are held
+    for up to flush_after seconds or max_lines, then sent together. Call flush()
+    once the producer is finished.
+    """
+    def __init__(self, q, flush_after=0.1, max_lines=32):
+        self.q = q
+        self.flush_after = flush_after
+        self.max_lines = max_lines
+        self.lines = []
+        self.last_flush = 0.0
+
+    def add(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= self.max_lines or time.monotonic() - self.last_flush >= self.flush_after:
+            self.flush()
+
+    def maybe_flush(self):
+        if self.lines and time.monotonic() - self.last_flush >= self.flush_after:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.q.put({"log": "\n".join(self.lines)})
+            self.lines = []
+        self.last_flush = time.monotonic()
+
+# ffmpeg writes machine-readable "key=value" progress blocks to stdout, and only
+# real errors to stderr, instead of a human-readable stats line to be regexed.
+FFMPEG_PROGRESS_ARGS = ["-nostats", "-loglevel", "error", "-progress", "pipe:1"]
+
+def run_ffmpeg_with_progress(command, duration, stage, q, span=(0, 100)):
+    """Runs an ffmpeg command built with FFMPEG_PROGRESS_ARGS, reporting percent of duration.
+
+    The percent is mapped onto span, so multi-pass encodes can share one bar.
+    """
+    start, width = span[0], span[1] - span[0]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=0, **SPAWN_KWARGS)
+    enlarge_pipe(process.stdout)
+    progress = ProgressThrottle(q)
+    log = LogBatcher(q)
+    try:
+        for line in pipe_lines(process.stdout):
+            kill_if_cancelled(process, q)
+            key, sep, value = line.strip().partition('=')
+            if not sep or ' ' in key:
+                log.add(line.strip())  # an error message from stderr
+                continue
+            log.maybe_flush()
+            if key == 'out_time_us' and duration > 0 and value.isdigit():
+                progress.update(stage, start + width * min(1.0, int(value) / 1e6 / duration))
+            elif key == 'progress' and value == 'end':
+                # The last out_time_us often stops short of the probed duration.
+                progress.update(stage, span[1])
+    finally:
+        log.flush()
     if process.wait() != 0:
         raise subprocess.CalledProcessError(process.returncode, command)
 
+class QueueLogger:
+    """Forwards in-process yt-dlp output to a job's progress queue."""
+    def __init__(self, q):
+        self.q = q
+
+    def debug(self, msg):
+        # yt-dlp routes regular screen output through debug(); skip real debug noise.
+        if not msg.startswith('[debug] '):
+            self.q.put({"log": msg})
+
+    def info(self, msg):
+        self.q.put({"log": msg})
+
+    def warning(self, msg):
+        self.q.put({"log": f"WARNING: {msg}"})
+
+    def error(self, msg):
+        self.q.put({"log": msg})
+
+def make_progress_hook(q, stage):
+    """Builds a yt-dlp progress hook that reports byte-accurate percentages."""
+    progress = ProgressThrottle(q)
+    def hook(d):
+        q.check_cancelled()  # raising here aborts the yt-dlp download
+        if d.get('status') == 'downloading':
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            if total:
+                progress.update(stage, min(100.0, d.get('downloaded_bytes', 0) * 100 / total))
+        elif d.get('status') == 'finished':
+            q.put({"log": f"Finished downloading {os.path.basename(d.get('filename', ''))}"})
+    return hook
+
+def make_postprocessor_hook(q):
+    """Builds a yt-dlp postprocessor hook that shows each merge/remux step as a stage."""
+    current = None
+    def hook(d):
+        nonlocal current
+        q.check_cancelled()
+        # yt-dlp can report 'started' more than once for the same step.
+        if d.get('status') == 'started' and d.get('postprocessor') != current:
+            current = d.get('postprocessor')
+            q.put({"stage": f"Post-processing ({current or 'ffmpeg'})...", "percent": 100})
+    return hook
+
+def download_opts(q, stage, selector, outtmpl):
+    """yt-dlp options for downloading selector to outtmpl inside a job, reporting to q."""
+    ydl_opts = {
+        'format': selector,
+        'outtmpl': outtmpl,
+        'merge_output_format': 'mkv',
+        'cachedir': YT_DLP_CACHE_DIR,
+        'concurrent_fragment_downloads': YT_DLP_FRAGMENTS,
+        'buffersize': YT_DLP_BUFFER_SIZE,
+        'http_chunk_size': YT_DLP_HTTP_CHUNK_SIZE,
+        'postprocessor_args': YT_DLP_MERGER_ARGS,
+        'noprogress': True,
+        'logger': QueueLogger(q),
+        'progress_hooks': [make_progress_hook(q, stage)],
+        'postprocessor_hooks': [make_postprocessor_hook(q)],
+    }
+    if os.path.exists(COOKIES_FILE):
+        ydl_opts['cookiefile'] = COOKIES_FILE
+    return ydl_opts
+
+class UploadProgressReader:
+    """Wraps an open file so requests streams it from disk while we report progress.
+
+    Iterated rather than read(): http.client pulls file-like bodies in 8-16 KiB
+    blocks, while iteration hands it 1 MiB chunks. __len__ still gives requests
+    the Content-Length, so the body is not sent chunked.
+    """
+    chunk_size = 1024 * 1024
+
+    def __init__(self, f, total, q, stage):
+        self.f = f
+        self.total = total
+        self.q = q
+        self.stage = stage
+        self.sent = 0
+        self.last_percent = 0.0
+
+    def __len__(self):
+        return self.total
+
+    def __iter__(self):
+        while True:
+            self.q.check_cancelled()
+            chunk = self.f.read(self.chunk_size)
+            if not chunk:
+                return
+            self.sent += len(chunk)
+            percent = self.sent * 100 / self.total if self.total else 100.0
+            if percent - self.last_percent >= 1 or self.sent == self.total:
+                self.last_percent = percent
+                self.q.put({"stage": self.stage, "percent": percent})
+            yield chunk
+
+def put_to_pixeldrain(file_path, filename, q, stage):
+    """Streams one file to Pixeldrain and returns its file id (raises on failure)."""
+    # PUT takes the raw file as the body, so it is streamed instead of being
+    # read into memory to build a multipart form.
+    api_url = f"https://pixeldrain.com/api/file/{quote(filename, safe='')}"
+    with open(file_path, 'rb') as f:
+        body = UploadProgressReader(f, os.path.getsize(file_path), q, stage)
+        response = SESSION.put(api_url, data=body, auth=pixeldrain_auth(), timeout=PIXELDRAIN_TIMEOUT)
+    response.raise_for_status()
+    result = response.json()
+    if not result.get("id"):
+        raise RuntimeError(f"Pixeldrain API error: {result.get('message', 'Unknown')}")
+    return result["id"]
+
+def pixeldrain_auth():
+    # Passed per request rather than set on SESSION, which also talks to other hosts.
+    return ('', PIXELDRAIN_API_KEY) if PIXELDRAIN_API_KEY else None
+
 def upload_to_pixeldrain(file_path, filename, q):
     try:
-        q.put({"stage": f"Uploading '{filename}' to Pixeldrain...", "percent": 10})
-        api_url = "https://pixeldrain.com/api/file"
-        with open(file_path, 'rb') as f:
-            files = {'file': (filename, f)}
-            auth = ('', PIXELDRAIN_API_KEY) if PIXELDRAIN_API_KEY else None
-            q.put({"stage": "Sending data...", "percent": 50})
-            response = requests.post(api_url, files=files, auth=auth)
+        stage = f"Uploading '{filename}' to Pixeldrain..."
+        q.put({"stage": stage, "percent": 0})
+        file_id = put_to_pixeldrain(file_path, filename, q, stage)
+        pixeldrain_url = f"https://pixeldrain.com/u/{file_id}"
+        q.put({"stage": "✅ Pixeldrain Upload Complete!", "percent": 100})
+        q.put({"log": f"Success! Link: {pixeldrain_url}", "final_url": pixeldrain_url})
+    except Exception as e:
+        q.put({"error": f"Pixeldrain upload failed: {str(e)}"})
+
+def upload_batch_to_pixeldrain(file_paths, title, q):
+    """Uploads several files over the pooled session, then groups them into one Pixeldrain list."""
+    try:
+        file_ids = []
+        for n, file_path in enumerate(file_paths, 1):
+            filename = os.path.basename(file_path)
+            stage = f"Uploading {n}/{len(file_paths)}: '{filename}'..."
+            q.put({"stage": stage, "percent": 0})
+            file_ids.append(put_to_pixeldrain(file_path, filename, q, stage))
+            q.put({"log": f"Uploaded {filename}: https://pixeldrain.com/u/{file_ids[-1]}"})
+        q.put({"stage": "Creating Pixeldrain list...", "percent": 100})
+        response = SESSION.post("https://pixeldrain.com/api/list", auth=pixeldrain_auth(), timeout=PIXELDRAIN_TIMEOUT,
+                                json={"title": title, "files": [{"id": file_id} for file_id in file_ids]})
         response.raise_for_status()
         result = response.json()
-        if result.get("success"):
-            file_id = result.get("id")
-            pixeldrain_url = f"https://pixeldrain.com/u/{file_id}"
-            q.put({"stage": "✅ Pixeldrain Upload Complete!", "percent": 100})
-            q.put({"log": f"Success! Link: {pixeldrain_url}", "final_url": pixeldrain_url})
-        else:
-            q.put({"error": f"Pixeldrain API error: {result.get('message', 'Unknown')}"})
+        if not result.get("id"):
+            raise RuntimeError(f"Pixeldrain API error: {result.get('message', 'Unknown')}")
+        list_url = f"https://pixeldrain.com/l/{result['id']}"
+        q.put({"stage": "✅ Pixeldrain List Created!", "percent": 100})
+        q.put({"log": f"Success! Link: {list_url}", "final_url": list_url})
     except Exception as e:
-        q.put({"error": f"Pixeldrain upload failed: {str(e)}"})
-    finally:
-        q.put({"log": "DONE"})
+        q.put({"error": f"Pixeldrain batch upload failed: {str(e)}"})
 
-def get_audio_channels(file_path):
+@lru_cache(maxsize=256)
+def _probe_media(file_path, mtime_ns, size):
+    duration, channels = 0.0, 2
     try:
-        ffprobe_cmd = ["ffprobe", "-v", "error", "-select_streams", "a:0", "-show_entries", "stream=channels", "-of", "default=noprint_wrappers=1:nokey=1", file_path]
-        channels_str = subprocess.check_output(ffprobe_cmd, universal_newlines=True, stderr=subprocess.DEVNULL).strip()
-        return int(channels_str) if channels_str else 2
+        if av is not None:
+            with av.open(file_path) as container:
+                if container.duration:
+                    duration = container.duration / av.time_base
+                audio = next(iter(container.streams.audio), None)
+                if audio is not None and audio.codec_context.channels:
+                    channels = audio.codec_context.channels
+        else:
+            out = subprocess.check_output(
+                [FFPROBE, "-v", "error", "-show_entries", "format=duration:stream=codec_type,channels",
+                 "-of", "json", file_path], stderr=subprocess.DEVNULL, **SPAWN_KWARGS)
+            data = json.loads(out)
+            duration = float(data.get('format', {}).get('duration') or 0)
+            audio = next((s for s in data.get('streams', []) if s.get('codec_type') == 'audio'), None)
+            if audio and audio.get('channels'):
+                channels = int(audio['channels'])
     except Exception:
-        return 2
+        pass
+    return {"duration": duration, "audio_channels": channels}
+
+def probe_media(file_path):
+    """Returns duration and audio channel count, probing each version of a file once.
+
+    Uses PyAV in-process when installed, else a single ffprobe call. The cache key
+    includes mtime and size, so a re-encoded or replaced file is probed again.
+    """
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return {"duration": 0.0, "audio_channels": 2}
+    return _probe_media(file_path, st.st_mtime_ns, st.st_size)
+
+def get_audio_channels(file_path):
+    return probe_media(file_path)["audio_channels"]
 
 def get_media_duration(file_path):
+    return probe_media(file_path)["duration"]
+
+# GPU encoders offered next to x265/SVT-AV1 when the host can run them.
+HW_ENCODERS = {
+    "hevc_nvenc": "H.265 (NVIDIA NVENC)",
+    "av1_nvenc": "AV1 (NVIDIA NVENC)",
+    "hevc_qsv": "H.265 (Intel Quick Sync)",
+    "av1_qsv": "AV1 (Intel Quick Sync)",
+    "hevc_vaapi": "H.265 (VAAPI)",
+    "av1_vaapi": "AV1 (VAAPI)",
+    "hevc_videotoolbox": "H.265 (Apple VideoToolbox)",
+}
+VAAPI_DEVICE = os.environ.get("VAAPI_DEVICE", "/dev/dri/renderD128")
+
+def hw_input_args(encoder):
+    return ["-vaapi_device", VAAPI_DEVICE] if encoder.endswith("_vaapi") else []
+
+def hw_video_args(encoder, preset, quality, bitrate_kbps=0):
+    """ffmpeg video options for a hardware encoder: constant quality, or bitrate when given.
+
+    Hardware encoders rate-control in a single pass, so a 2-pass request maps to a
+    one-pass encode at the requested bitrate.
+    """
+    vendor = encoder.rsplit("_", 1)[1]
+    args = ["-c:v", encoder]
+    if vendor == "vaapi":
+        args += ["-vf", "format=nv12,hwupload"]
+    elif preset and vendor != "videotoolbox":
+        args += ["-preset", preset]
+    if bitrate_kbps:
+        args += ["-b:v", f"{bitrate_kbps}k"]
+    elif vendor == "nvenc":
+        args += ["-rc", "vbr", "-cq", str(quality), "-b:v", "0"]
+    elif vendor == "qsv":
+        args += ["-global_quality", str(quality)]
+    elif vendor == "videotoolbox":
+        # -q:v runs 1-100 with higher meaning better; CRF 28 lands around 44.
+        args += ["-q:v", str(max(1, min(100, 100 - 2 * quality)))]
+    else:
+        args += ["-rc_mode", "CQP", "-qp", str(quality)]
+    return args
+
+@lru_cache(maxsize=None)
+def usable_hw_encoders():
+    """Returns the HW_ENCODERS this host can actually use, probed once per process.
+
+    Being listed by `ffmpeg -encoders` only means support was compiled in, so each
+    candidate also gets a tiny test encode to confirm the GPU and driver are there.
+    """
     try:
-        cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", file_path]
-        out = subprocess.check_output(cmd, universal_newlines=True, stderr=subprocess.DEVNULL).strip()
-        return float(out) if out else 0.0
-    except Exception:
-        return 0.0
+        listed = subprocess.check_output([FFMPEG, "-hide_banner", "-encoders"], stderr=subprocess.DEVNULL,
+                                         universal_newlines=True, **SPAWN_KWARGS)
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    usable = {}
+    for encoder, label in HW_ENCODERS.items():
+        if f" {encoder} " not in listed:
+            continue
+        test_cmd = [FFMPEG, "-hide_banner", "-v", "error", *hw_input_args(encoder),
+                    "-f", "lavfi", "-i", "color=size=256x256:duration=0.1",
+                    *hw_video_args(encoder, "", 30), "-f", "null", "-"]
+        try:
+            subprocess.run(test_cmd, check=True, timeout=15, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **SPAWN_KWARGS)
+        except (OSError, subprocess.SubprocessError):
+            continue
+        usable[encoder] = label
+    return usable
+
+app.jinja_env.globals['hw_encoders'] = usable_hw_encoders
 
 # -----------------------------
 # Core operations
@@ -926,10 +1392,10 @@ def encode_file(input_path, output_filename, codec, preset, pass_mode, bitrate,
     safe_output = get_safe_filename(output_filename)
     output_path = os.path.join(DOWNLOAD_FOLDER, safe_output)
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    if os.path.exists(output_path):
-        os.remove(output_path)
+    # Write under a hidden name and swap it in at the end, so a failed or cancelled
+    # encode never leaves a truncated file behind (or clobbers an existing one).
+    partial_path = os.path.join(os.path.dirname(output_path), PARTIAL_PREFIX + os.path.basename(output_path))
     try:
-        while not q.empty(): q.get()
         q.put({"stage": "Initializing encoding...", "percent": 0})
         if not is_media_file(input_path):
             q.put({"error": "This file type cannot be encoded. Only video and audio files are supported."})
@@ -937,72 +1403,78 @@ def encode_file(input_path, output_filename, codec, preset, pass_mode, bitrate,
         duration = get_media_duration(input_path)
         
         if codec == "none":
-            shutil.copy2(input_path, output_path)
+            shutil.copy2(input_path, partial_path)
+            os.replace(partial_path, output_path)
             q.put({"stage": "✅ Copied!", "percent": 100, "log": "File copied without encoding."})
         else:
-            video_codec = "libx265" if codec == "h265" else "libsvtav1"
-            crf_val = int(crf) if crf else (28 if codec == 'h265' else 35)
+            hw = codec in HW_ENCODERS
+            if hw and codec not in usable_hw_encoders():
+                raise RuntimeError(f"Encoder {codec} is not available on this server.")
+            video_codec = codec if hw else "libx265" if codec == "h265" else "libsvtav1"
+            crf_val = int(crf) if crf else (35 if "av1" in codec else 28)
             bitrate_val = int(bitrate) if bitrate and bitrate.strip() else 0
-            stage_msg = f"Encoding to {codec.upper()}..."
+            stage_msg = f"Encoding to {HW_ENCODERS[codec] if hw else codec.upper()}..."
             q.put({"stage": stage_msg, "percent": 0})
             
-            ffmpeg_cmd = ["ffmpeg", "-y", "-i", input_path]
-            if pass_mode == "2-pass":
-                if bitrate_val == 0:
-                    q.put({"error": "Video bitrate is required for 2-pass encoding."}); return
+            ffmpeg_cmd = [FFMPEG, "-y", *FFMPEG_PROGRESS_ARGS, *hw_input_args(video_codec), "-i", input_path]
+            span = (0, 100)
+            if pass_mode == "2-pass" and bitrate_val == 0:
+                q.put({"error": "Video bitrate is required for 2-pass encoding."}); return
+            if hw:
+                ffmpeg_cmd.extend(hw_video_args(video_codec, preset, crf_val, bitrate_val if pass_mode == "2-pass" else 0))
+            elif pass_mode == "2-pass":
                 video_opts = ["-c:v", video_codec, "-preset", preset, "-b:v", f"{bitrate_val}k"]
                 pass1_cmd = ffmpeg_cmd + video_opts + ["-pass", "1", "-an", "-f", "null", "-"]
-                subprocess.run(pass1_cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                # Each pass fills half of the progress bar.
+                run_ffmpeg_with_progress(pass1_cmd, duration, f"{stage_msg} (pass 1/2)", q, span=(0, 50))
+                q.check_cancelled()
                 ffmpeg_cmd.extend(video_opts + ["-pass", "2"])
+                stage_msg, span = f"{stage_msg} (pass 2/2)", (50, 100)
             else:
                 ffmpeg_cmd.extend(["-c:v", video_codec, "-preset", preset, "-crf", str(crf_val)])
             
             if fps: ffmpeg_cmd.extend(["-r", fps])
             audio_bitrate_val = int(audio_bitrate) if audio_bitrate else 96
             ffmpeg_cmd.extend(["-ac", "2" if force_stereo else str(get_audio_channels(input_path)), "-c:a", "libopus", "-b:a", f"{audio_bitrate_val}k"])
-            ffmpeg_cmd.append(output_path)
+            ffmpeg_cmd.append(partial_path)
             
-            process = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, encoding='utf-8', errors='ignore')
-            for line in iter(process.stdout.readline, ''):
-                q.put({"log": line.strip()})
-                if duration > 0:
-                    match = re.search(r'time=(\d{2}):(\d{2}):(\d{2})\.(\d{2})', line)
-                    if match:
-                        h, m, s, ms = map(int, match.groups())
-                        percent = min(100, ((h*3600 + m*60 + s + ms/100) / duration) * 100)
-                        q.put({"stage": stage_msg, "percent": percent})
-            if process.wait() != 0:
-                raise subprocess.CalledProcessError(process.returncode, ffmpeg_cmd)
+            run_ffmpeg_with_progress(ffmpeg_cmd, duration, stage_msg, q, span)
+            os.replace(partial_path, output_path)
             q.put({"stage": "✅ Encoding Complete!", "percent": 100})
 
         if upload_pixeldrain:
             upload_to_pixeldrain(output_path, os.path.basename(safe_output), q)
+        drop_page_cache(input_path, output_path)
     except Exception as e:
         q.put({"error": str(e)})
     finally:
-        q.put({"log": "DONE"})
+        if os.path.exists(partial_path):
+            try: os.remove(partial_path)
+            except OSError: pass
 
-def download_and_convert(url, video_id, audio_id, filename, codec, preset, pass_mode, bitrate, crf, audio_bitrate, fps, force_stereo, q, is_muxed, **kwargs):
+def download_and_convert(url, video_id, audio_id, filename, codec, preset, pass_mode, bitrate, crf, audio_bitrate, fps, force_stereo, q, **kwargs):
     safe_name = get_safe_filename(filename)
     base_name, _ = os.path.splitext(safe_name)
     final_path = os.path.join(DOWNLOAD_FOLDER, safe_name)
     tmp_path = os.path.join(DOWNLOAD_FOLDER, base_name + ".part.mkv")
     try:
-        while not q.empty(): q.get()
         q.put({"stage": "Initializing download.", "percent": 0})
-        
-        format_selector = video_id
+
+        info = get_info(url)
+        format_selector = check_format_id(video_id)
+        is_muxed = any(f.get('format_id') == video_id and is_muxed_format(f) for f in info_formats(info))
         if not is_muxed and audio_id:
+            check_format_id(audio_id)
             format_selector += f"+{audio_id}"
         elif not is_muxed: # Video only stream selected, and no audio selected, so pick best audio
             format_selector += "+bestaudio"
 
-        yt_dlp_cmd = [sys.executable, "-m", "yt_dlp", "-f", format_selector, "-o", tmp_path, "--merge-output-format", "mkv", url]
-        if os.path.exists(COOKIES_FILE):
-            yt_dlp_cmd.extend(["--cookies", COOKIES_FILE])
-            
-        run_command_with_progress(yt_dlp_cmd, "Downloading with yt-dlp.", q)
+        ydl_opts = download_opts(q, "Downloading with yt-dlp.", format_selector, tmp_path.replace('%', '%%'))
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            # Download from the extraction cached by the fetch step instead of the URL.
+            download_info(ydl, info)
         q.put({"stage": "Download Complete", "percent": 100})
+        q.check_cancelled()
         
         if not os.path.exists(tmp_path):
              raise FileNotFoundError("yt-dlp did not create the expected file.")
@@ -1017,13 +1489,14 @@ def download_and_convert(url, video_id, audio_id, filename, codec, preset, pass_
         
         if kwargs.get("upload_pixeldrain") and codec == "none":
             upload_to_pixeldrain(final_path, os.path.basename(final_path), q)
+        if codec == "none":
+            drop_page_cache(final_path)  # encode_file drops its own output
     except Exception as e:
         q.put({"error": str(e)})
     finally:
         if os.path.exists(tmp_path):
             try: os.remove(tmp_path)
             except OSError: pass
-        q.put({"log": "DONE"})
 
 def manual_merge_worker(url, video_id, audio_id, filename, q, upload_pixeldrain=False):
     safe_name = get_safe_filename(filename)
@@ -1032,51 +1505,52 @@ def manual_merge_worker(url, video_id, audio_id, filename, q, upload_pixeldrain=
     final_path = os.path.join(DOWNLOAD_FOLDER, safe_name)
 
     try:
-        while not q.empty(): q.get()
         q.put({"stage": "Preparing manual merge...", "percent": 0})
 
-        selector = video_id.strip()
+        selector = check_format_id(video_id.strip())
         if audio_id and audio_id.strip():
-            selector += "+" + audio_id.strip()
-
-        cmd = [
-            sys.executable, "-m", "yt_dlp",
-            "-f", selector,
-            "--merge-output-format", "mkv",
-            "-o", final_path,
-            "--newline",
-            url
-        ]
-        if os.path.exists(COOKIES_FILE):
-            cmd += ["--cookies", COOKIES_FILE]
+            selector += "+" + check_format_id(audio_id.strip())
+
+        # Let yt-dlp pick the real extension, then stream-copy into MKV: pairs are
+        # merged with "-c copy" and a single stream is remuxed rather than left in
+        # its original container under a .mkv name. "%" is escaped for the template.
+        out_template = os.path.splitext(final_path)[0].replace('%', '%%') + ".%(ext)s"
+        ydl_opts = download_opts(q, "Downloading & merging formats...", selector, out_template)
+        ydl_opts['postprocessors'] = [{'key': 'FFmpegVideoRemuxer', 'preferedformat': 'mkv'}]
 
-        run_command_with_progress(cmd, "Downloading & merging formats...", q)
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            # Reuse the extraction from the fetch step instead of the URL.
+            download_info(ydl, get_info(url))
         q.put({"stage": "Merge completed!", "percent": 100})
 
         if upload_pixeldrain and os.path.exists(final_path):
             upload_to_pixeldrain(final_path, os.path.basename(final_path), q)
+        drop_page_cache(final_path)
 
     except Exception as e:
         q.put({"error": f"Manual merge failed: {str(e)}"})
-    finally:
-        q.put({"log": "DONE"})
+
+# Content-Disposition filenames: RFC 5987 filename*=charset''name, then plain filename=.
+_CD_FILENAME_STAR_RE = re.compile(r"filename\*=([^']*)''([^;]*)")
+_CD_FILENAME_RE = re.compile(r'filename="?([^"]+)"?')
 
 def download_file_directly(url, q, upload_pixeldrain_direct=False):
+    partial_path = None
     try:
-        while not q.empty(): q.get()
         q.put({"stage": "Starting direct download.", "percent": 0})
-        with requests.get(url, stream=True, allow_redirects=True, headers={'User-Agent': 'Mozilla/5.0'}) as r:
+        with SESSION.get(url, stream=True, allow_redirects=True, headers={'User-Agent': 'Mozilla/5.0'},
+                         timeout=DIRECT_DOWNLOAD_TIMEOUT) as r:
             r.raise_for_status()
             filename = None
             cd_header = r.headers.get('content-disposition')
             if cd_header:
-                match_star = re.search(r"filename\\*=([^']*)''([^;]*)", cd_header)
+                match_star = _CD_FILENAME_STAR_RE.search(cd_header)
                 if match_star:
                     charset = match_star.group(1); encoded_name = match_star.group(2)
                     try: filename = unquote(encoded_name, encoding=charset)
                     except Exception: filename = unquote(encoded_name)
                 if not filename:
-                    match_simple = re.search(r'filename="?([^"]+)"?', cd_header)
+                    match_simple = _CD_FILENAME_RE.search(cd_header)
                     if match_simple: raw_name = match_simple.group(1); filename = raw_name
             if not filename:
                 filename_from_url = url.split('/')[-1].split('?')[0]
@@ -1084,25 +1558,36 @@ def download_file_directly(url, q, upload_pixeldrain_direct=False):
                 else: filename = "direct_download"
             safe_name = get_safe_filename(filename)
             final_path = os.path.join(DOWNLOAD_FOLDER, safe_name)
+            # Preallocate and write under a hidden name, so a failed or cancelled
+            # download never leaves a full-size, zero-tailed file in the listing.
+            partial_path = os.path.join(os.path.dirname(final_path), PARTIAL_PREFIX + os.path.basename(final_path))
             total_size = int(r.headers.get('content-length', 0))
             downloaded_size = 0
             q.put({"log": f"Identified filename: '{filename}'"})
             q.put({"log": f"Saving as: '{safe_name}'"})
             os.makedirs(os.path.dirname(final_path), exist_ok=True)
-            with open(final_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
+            progress = ProgressThrottle(q)
+            with open(partial_path, 'wb') as f:
+                preallocate(f, total_size)
+                for chunk in r.iter_content(chunk_size=WRITE_CHUNK_SIZE):
                     if not chunk: continue
+                    q.check_cancelled()
                     f.write(chunk); downloaded_size += len(chunk)
                     if total_size > 0:
                         percent = (downloaded_size / total_size) * 100
-                        q.put({"stage": "Downloading...", "percent": percent})
+                        progress.update("Downloading...", percent)
+                f.truncate(downloaded_size)  # drop any preallocated tail the body didn't fill
+            os.replace(partial_path, final_path)
             q.put({"stage": "✅ Saved!", "percent": 100})
             if upload_pixeldrain_direct:
                 upload_to_pixeldrain(final_path, os.path.basename(final_path), q)
+            drop_page_cache(final_path)
     except Exception as e:
         q.put({"error": f"Direct download failed: {str(e)}"})
     finally:
-        q.put({"log": "DONE"})
+        if partial_path and os.path.exists(partial_path):
+            try: os.remove(partial_path)
+            except OSError: pass
 
 # -----------------------------
 # Flask routes
@@ -1115,7 +1600,7 @@ def index():
     }
     if 'last_upload_url' in session:
         flash(f"✅ Upload completed! <a href='{session.pop('last_upload_url')}' target='_blank'>View Link</a>", "success")
-    return render_template_string(TEMPLATE, **template_vars)
+    return COMPILED_TEMPLATE.render(**template_vars)
 
 @app.route("/", methods=["POST"])
 def index_post():
@@ -1128,87 +1613,123 @@ def index_post():
         "download_started": False
     }
 
+    # ?nocache=1 forces a fresh extraction instead of reusing a cached one.
+    refresh = request.values.get("nocache") == "1"
+
     if action == "fetch":
-        raw, vfmt, afmt = fetch_formats(form_data["url"])
+        raw, vfmt, afmt, title = fetch_formats(form_data["url"], refresh)
         if raw:
             form_data.update({
                 "formats": raw, "video_formats": vfmt,
-                "audio_formats": afmt, "original_name": get_original_filename(form_data["url"])
+                "audio_formats": afmt, "original_name": f"{title}.mkv"
             })
-            session['video_formats_for_mux_check'] = vfmt
             flash("Formats loaded successfully!", "success")
-        return render_template_string(TEMPLATE, **form_data)
+        return COMPILED_TEMPLATE.render(**form_data)
     
     elif action == "manual_fetch":
-        raw, _, __ = fetch_formats(form_data["manual_url"])
+        raw, _, __, title = fetch_formats(form_data["manual_url"], refresh)
         if raw:
             form_data["manual_formats_raw"] = raw
-            form_data["manual_filename"] = get_original_filename(form_data["manual_url"]).replace('.mkv', '')
+            form_data["manual_filename"] = title
             flash("Manual formats loaded!", "success")
-        return render_template_string(TEMPLATE, **form_data)
+        return COMPILED_TEMPLATE.render(**form_data)
     
     if action in ["download", "direct_download", "direct_upload_pixeldrain", "manual_merge"]:
         form_data["download_started"] = True
-        thread = None
+        job_id, q = create_job()
+        form_data["job_id"] = job_id
 
         if action == "download":
-            video_formats = session.pop('video_formats_for_mux_check', [])
-            video_id = request.form.get("video_id")
-            is_muxed = any(f['id'] == video_id and f.get('is_muxed') for f in video_formats)
-            thread = threading.Thread(
-                target=download_and_convert,
-                args=(
-                    request.form.get("url"), video_id, request.form.get("audio_id"),
-                    request.form.get("filename"), request.form.get("codec"), request.form.get("preset"),
-                    request.form.get("pass_mode"), request.form.get("bitrate"), request.form.get("crf"),
-                    request.form.get("audio_bitrate"), request.form.get("fps"),
-                    request.form.get("force_stereo") == "true", progress_queue, is_muxed
-                ),
-                kwargs={"upload_pixeldrain": request.form.get("upload_pixeldrain") == "true"}
+            submit_job(
+                job_id, download_and_convert,
+                request.form.get("url"), request.form.get("video_id"), request.form.get("audio_id"),
+                request.form.get("filename"), request.form.get("codec"), request.form.get("preset"),
+                request.form.get("pass_mode"), request.form.get("bitrate"), request.form.get("crf"),
+                request.form.get("audio_bitrate"), request.form.get("fps"),
+                request.form.get("force_stereo") == "true", q,
+                upload_pixeldrain=request.form.get("upload_pixeldrain") == "true"
             )
         
         elif action == "manual_merge":
             upload = request.form.get("upload_pixeldrain_manual") == "true"
-            thread = threading.Thread(
-                target=manual_merge_worker,
-                args=(
-                    request.form.get("manual_url"), request.form.get("manual_video_id"),
-                    request.form.get("manual_audio_id"), request.form.get("manual_filename"),
-                    progress_queue, upload
-                )
+            submit_job(
+                job_id, manual_merge_worker,
+                request.form.get("manual_url"), request.form.get("manual_video_id"),
+                request.form.get("manual_audio_id"), request.form.get("manual_filename"),
+                q, upload
             )
         
         elif action == "direct_download":
-            thread = threading.Thread(
-                target=download_file_directly,
-                args=(
-                    request.form.get("direct_url"), progress_queue,
-                    request.form.get("upload_pixeldrain_direct") == "true"
-                )
+            submit_job(
+                job_id, download_file_directly,
+                request.form.get("direct_url"), q,
+                request.form.get("upload_pixeldrain_direct") == "true"
             )
         
         elif action == "direct_upload_pixeldrain":
-             thread = threading.Thread(target=download_file_directly, args=(request.form.get("direct_url"), progress_queue, True))
-
-        if thread:
-            thread.daemon = True
-            thread.start()
+            submit_job(job_id, download_file_directly, request.form.get("direct_url"), q, True)
             
-    return render_template_string(TEMPLATE, **form_data)
-
-@app.route("/progress")
-def progress_stream():
+    return COMPILED_TEMPLATE.render(**form_data)
+
+@app.route("/progress/<token>")
+def progress_stream(token):
+    job = lookup_job(token)
+    q = job["channel"] if job else None
+    # Browsers resend the last id they saw when they reconnect on their own; the
+    # page's watchdog passes it as a query argument when it reopens the stream.
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id", "")
+    last_event_id = int(last_event_id) if last_event_id.isdigit() else 0
     def generate():
-        while True:
-            try:
-                msg = progress_queue.get(timeout=30)
-                yield f"data: {json.dumps(msg)}\n\n"
-                if msg.get("log") == "DONE": break
-            except queue.Empty:
-                yield ': keep-alive\n\n'
-            except GeneratorExit:
-                break
-    return Response(generate(), mimetype="text/event-stream")
+        if q is None:
+            yield sse_event({'error': 'Unknown or expired job.'})
+            return
+        # Reconnect quickly if a proxy or network blip drops the stream.
+        yield SSE_RETRY_FRAME
+        subscription = q.subscribe(last_event_id)
+        messages, event = subscription
+        try:
+            while True:
+                # Clear before draining so a put() that lands after the drain still wakes us.
+                event.clear()
+                while messages:
+                    frame, done = messages.popleft()
+                    yield frame
+                    if done:
+                        return
+                if q.done_at is not None and not messages:
+                    return  # reconnected after already seeing DONE
+                if not event.wait(SSE_HEARTBEAT_SECONDS):
+                    yield SSE_HEARTBEAT_FRAME
+        finally:
+            q.unsubscribe(subscription)
+    # Tell nginx/Cloudflare not to buffer the stream, browsers not to cache it, and
+    # proxies not to compress it (which would also hold frames back).
+    return Response(generate(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache, no-transform", "X-Accel-Buffering": "no"})
+
+@app.route("/status")
+def job_status():
+    with JOBS_LOCK:
+        jobs = list(JOBS.items())
+    statuses = []
+    for job_id, job in jobs:
+        stage, percent = job["channel"].progress or (None, None)
+        statuses.append({"job_id": job_id, "running": bool(job["future"] and job["future"].running()),
+                         "done": bool(job["future"] and job["future"].done()),
+                         "stage": stage, "percent": percent})
+    return jsonify(statuses)
+
+@app.route("/cancel/<token>", methods=["POST"])
+def cancel_job(token):
+    job = lookup_job(token)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job."}), 404
+    job["channel"].cancelled.set()
+    # A job still waiting for a free worker will never start, so end its stream here.
+    if job["future"] and job["future"].cancel():
+        job["channel"].put({"error": "Cancelled by user."})
+        job["channel"].put({"log": "DONE"})
+    return jsonify({"cancelled": True})
 
 @app.route("/upload_direct", methods=["POST"])
 def upload_direct():
@@ -1217,13 +1738,28 @@ def upload_direct():
         filename = secure_filename(file.filename)
         file_path = os.path.join(DOWNLOAD_FOLDER, filename)
         file.save(file_path)
-        thread = threading.Thread(target=upload_to_pixeldrain, args=(file_path, filename, progress_queue))
-        thread.daemon = True
-        thread.start()
-        return render_template_string(FILE_OPERATION_TEMPLATE, operation_title=f"Uploading: {filename}", download_started=True)
+        job_id, q = create_job()
+        submit_job(job_id, upload_to_pixeldrain, file_path, filename, q)
+        return COMPILED_FILE_OPERATION_TEMPLATE.render(operation_title=f"Uploading: {filename}", download_started=True, job_id=job_id)
     flash("No file selected", "error")
     return redirect(url_for('index'))
 
+@app.route("/upload_folder/<path:folderpath>", methods=["POST"])
+def upload_folder(folderpath):
+    base = download_path(folderpath)
+    if base is None or not os.path.isdir(base):
+        flash("Invalid folder.", "error"); return redirect(url_for('list_files'))
+    file_paths = sorted(
+        os.path.join(root, name) for root, _, names in os.walk(base) for name in names
+        if not name.startswith(PARTIAL_PREFIX)
+    )
+    if not file_paths:
+        flash("Folder is empty.", "error"); return redirect(url_for('list_files', path=folderpath))
+    job_id, q = create_job()
+    title = os.path.basename(folderpath.rstrip('/'))
+    submit_job(job_id, upload_batch_to_pixeldrain, file_paths, title, q)
+    return COMPILED_FILE_OPERATION_TEMPLATE.render(operation_title=f"Uploading folder: {title}", download_started=True, job_id=job_id)
+
 @app.route("/upload_local", methods=["POST"])
 def upload_local():
     if 'file' in request.files and request.files['file'].filename:
@@ -1239,119 +1775,116 @@ def upload_local():
         flash("No file selected.", "error")
     return redirect(url_for('list_files'))
 
+# Template output pieces per streamed listing chunk (each row is a few dozen).
+LISTING_STREAM_BUFFER = 256
+
+# Characters werkzeug's path converter leaves unquoted when building URLs.
+URL_PATH_SAFE = "!$&'()*+,/:;=@"
+
+# Folders with at least STAT_PARALLEL_MIN entries are stat()ed on STAT_POOL.
+STAT_PARALLEL_MIN = 32
+STAT_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="stat")
+
+# One file-listing row: a tuple with named fields, lighter than a dict per entry.
+# Folders get open/upload URLs, files download/encode/delete ones; the rest are None.
+ListingRow = namedtuple("ListingRow", "sort_key is_dir display_path delete_prompt size modified "
+                                      "open_url upload_url download_url encode_url delete_url")
+
+def _list_entry(subpath, url_bases, entry):
+    """Builds one list_files row from a DirEntry, or None if it vanished mid-scan.
+
+    scandir hands back the type with each entry and caches its stat(), so each row
+    costs one syscall instead of a stat/isdir/getsize/isfile round.
+    """
+    try:
+        stat = entry.stat()
+        is_dir = entry.is_dir()
+    except OSError:  # dangling symlink or removed mid-scan
+        return None
+    rel_path = os.path.join(subpath, entry.name) if subpath else entry.name
+    path = quote(rel_path, safe=URL_PATH_SAFE)
+    open_base, upload_base, download_base, encode_base, delete_base = url_bases
+    if is_dir:
+        urls = (open_base + path, upload_base + path, None, None, None)
+    else:
+        urls = (None, None, download_base + path, encode_base + path, delete_base + path)
+    return ListingRow(
+        (not is_dir, -stat.st_mtime),  # folders first, then newest first
+        is_dir,
+        # Escaped here once rather than by the template; Markup is not re-escaped.
+        escape(rel_path), escape(json.dumps(f"Delete '{rel_path}'?")),
+        human_size(stat.st_size), timestamp_to_datetime(stat.st_mtime),
+        *urls,
+    )
+
 @app.route("/files")
 @app.route("/files/<path:path>")
 def list_files(path=""):
     subpath = path.strip("/")
-    base = os.path.join(DOWNLOAD_FOLDER, subpath) if subpath else DOWNLOAD_FOLDER
-    if not os.path.abspath(base).startswith(os.path.abspath(DOWNLOAD_FOLDER)):
+    base = download_path(subpath)
+    if base is None:
         flash("Invalid path.", "error"); return redirect(url_for('list_files'))
 
-    items = []
-    try: entries = os.listdir(base)
-    except FileNotFoundError: entries = []
-
-    for name in entries:
-        full = os.path.join(base, name)
-        rel_path = os.path.join(subpath, name) if subpath else name
-        stat = os.stat(full)
-        items.append({
-            "name": name, "path": rel_path, "display_path": rel_path,
-            "is_dir": os.path.isdir(full), "mtime": stat.st_mtime,
-            "size": get_file_size(full),
-            "is_media": is_media_file(full) if os.path.isfile(full) else False
-        })
-    items.sort(key=lambda x: (not x["is_dir"], -x["mtime"]))
-    parent_path = "/".join(subpath.split("/")[:-1]) if subpath else ""
-    parent_url = url_for("list_files", path=parent_path) if subpath else None
-
-    return render_template_string("""
-<!DOCTYPE html><html><head><title>Downloaded Files</title><style>
-body{font-family:-apple-system,BlinkMacSystemFont,"Segoe UI",Roboto,Helvetica,Arial,sans-serif;background-color:#f4f4f9;color:#333;margin:20px}
-.container{max-width:1000px;margin:auto;background:#fff;padding:20px;border-radius:8px;box-shadow:0 2px 10px rgba(0,0,0,0.1)}
-table{width:100%;border-collapse:collapse;margin-top:20px} th,td{padding:12px;border-bottom:1px solid #ddd;text-align:left;word-break:break-all}
-th{background-color:#f2f2f2} a{color:#007bff;text-decoration:none} a:hover{text-decoration:underline}
-.flash-msg{padding:10px;border-radius:4px;margin-bottom:15px} .flash-success{background-color:#d4edda;color:#155724} .flash-error{background-color:#f8d7da;color:#721c24}
-button,button-link{background-color:#007bff;color:#fff!important;padding:5px 10px;border:none;border-radius:4px;cursor:pointer;font-size:14px;margin-right:5px;text-decoration:none;display:inline-block}
-button:hover,button-link:hover{background-color:#0056b3} button.delete{background-color:#dc3545} button.delete:hover{background-color:#c82333}
-button.upload{background-color:#17a2b8} button.upload:hover{background-color:#138496}
-button.encode{background-color:#28a745} button.encode:hover{background-color:#218838} button.rename{background-color:#ffc107;color:#212529!important} button.rename:hover{background-color:#e0a800}
-.actions{white-space:nowrap} .actions form{display:inline-block}
-</style></head><body>
-<div class="container">
-    <h1>Files in {{ folder_name }}</h1>
-    {% with messages = get_flashed_messages(with_categories=true) %}
-        {% if messages %}
-            {% for category, message in messages %}
-                <div class="flash-msg flash-{{ category }}">{{ message|safe }}</div>
-            {% endfor %}
-        {% endif %}
-    {% endwith %}
-    {% if parent_url %}<p><a href="{{ parent_url }}">⬆️ Up</a></p>{% endif %}
-    <h3>Upload a file from your computer to the server</h3>
-    <form method="POST" action="{{ url_for('upload_local') }}" enctype="multipart/form-data" style="margin-bottom:20px;">
-        <input type="file" name="file" required>
-        <button type="submit" class="upload">Upload to Server</button>
-    </form>
-    {% if items %}
-        <table><thead><tr><th>Name</th><th>Size</th><th>Modified</th><th>Actions</th></tr></thead><tbody>
-        {% for item in items %}
-        <tr>
-            <td>{{ item.display_path }}</td>
-            <td>{{ item.size }}</td>
-            <td>{{ item.mtime | int | timestamp_to_datetime }}</td>
-            <td class="actions">
-                {% if item.is_dir %}
-                    <a href="{{ url_for('list_files', path=item.path) }}">Open</a>
-                {% else %}
-                    <a href="{{ url_for('download_file', filepath=item.path) }}">Download</a>
-                    <a href="{{ url_for('encode_page', filepath=item.path) }}" class="encode">Encode</a>
-                    <form method="POST" action="{{ url_for('delete_file', filepath=item.path) }}" style="display:inline;">
-                        <button type="submit" class="delete" onclick="return confirm('Delete \\'{{ item.display_path }}\\'?')">Delete</button>
-                    </form>
-                {% endif %}
-            </td>
-        </tr>
-        {% endfor %}
-        </tbody></table>
-    {% else %}
-        <p>No files downloaded yet.</p>
-    {% endif %}
-    <br><a href="{{ url_for('index') }}">🏠 Back to Main Page</a>
-</div>
-</body></html>
-    """, items=items, folder_name=subpath or "/", parent_url=parent_url)
-
-@app.template_filter('timestamp_to_datetime')
-def timestamp_to_datetime(s):
-    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(s))
+    # Filter on the name alone, before any row stats its entry.
+    skip = (lambda name: name.startswith(PARTIAL_PREFIX)) if request.args.get("show_hidden") else is_hidden_name
+    try:
+        with os.scandir(base) as it:
+            entries = [entry for entry in it if not skip(entry.name)]
+    except FileNotFoundError:
+        entries = []
+    # One url_for per endpoint instead of several per row: build each with a "_"
+    # placeholder path; rows append their own path quoted the way werkzeug would.
+    url_bases = tuple(
+        url_for(endpoint, **{arg: "_"})[:-1] for endpoint, arg in (
+            ("list_files", "path"), ("upload_folder", "folderpath"), ("download_file", "filepath"),
+            ("encode_page", "filepath"), ("delete_file", "filepath")))
+    build_row = partial(_list_entry, subpath, url_bases)
+    # On network mounts every stat() is a round-trip, so big folders stat in parallel.
+    if len(entries) >= STAT_PARALLEL_MIN:
+        items = list(STAT_POOL.map(build_row, entries))
+    else:
+        items = [build_row(entry) for entry in entries]
+    items = [item for item in items if item is not None]
+    items.sort(key=itemgetter(0))  # ListingRow.sort_key
+    # Reuse the list_files base built above; the top level is the bare /files route
+    # (url_for with path="" would give "/files/", which 404s).
+    parent_path = subpath.rpartition("/")[0]
+    open_base = url_bases[0]
+    parent_url = None
+    if subpath:
+        parent_url = open_base + quote(parent_path, safe=URL_PATH_SAFE) if parent_path else open_base[:-1]
+
+    # Pop the flashes now: the session cookie is written before a streamed body is
+    # rendered, and the template's later call reuses this request-cached result.
+    get_flashed_messages(with_categories=True)
+    # Stream the rows out as they render rather than building the whole page first.
+    stream = COMPILED_FILES_TEMPLATE.stream(items=items, folder_name=subpath or "/", parent_url=parent_url)
+    stream.enable_buffering(LISTING_STREAM_BUFFER)
+    return Response(stream_with_context(stream), mimetype="text/html")
 
 @app.route("/encode/<path:filepath>")
 def encode_page(filepath):
-    full_path = os.path.join(DOWNLOAD_FOLDER, filepath)
-    if not os.path.exists(full_path):
+    if existing_download(filepath) is None:
         flash("File not found.", "error"); return redirect(url_for('list_files'))
     suggested = os.path.basename(filepath)
-    return render_template_string(ENCODE_TEMPLATE, filepath=filepath, suggested_output=suggested, codec="none", pass_mode="1-pass", bitrate="", crf="", audio_bitrate="", download_started=False)
+    return COMPILED_ENCODE_TEMPLATE.render(filepath=filepath, suggested_output=suggested, codec="none", pass_mode="1-pass", bitrate="", crf="", audio_bitrate="", download_started=False)
 
 @app.route("/encode/<path:filepath>", methods=["POST"])
 def encode_file_post(filepath):
-    if not os.path.exists(os.path.join(DOWNLOAD_FOLDER, filepath)):
+    full_path = existing_download(filepath)
+    if full_path is None:
         flash("File not found.", "error"); return redirect(url_for('list_files'))
     output_filename = request.form.get("output_filename") or os.path.basename(filepath)
-    thread = threading.Thread(
-        target=encode_file,
-        args=(
-            os.path.join(DOWNLOAD_FOLDER, filepath), output_filename, request.form.get("codec"),
-            request.form.get("preset"), request.form.get("pass_mode"), request.form.get("bitrate"),
-            request.form.get("crf"), request.form.get("audio_bitrate"), request.form.get("fps"),
-            request.form.get("force_stereo") == "true", progress_queue
-        ),
-        kwargs={"upload_pixeldrain": request.form.get("upload_pixeldrain") == "true"}
+    job_id, q = create_job()
+    submit_job(
+        job_id, encode_file,
+        full_path, output_filename, request.form.get("codec"),
+        request.form.get("preset"), request.form.get("pass_mode"), request.form.get("bitrate"),
+        request.form.get("crf"), request.form.get("audio_bitrate"), request.form.get("fps"),
+        request.form.get("force_stereo") == "true", q,
+        upload_pixeldrain=request.form.get("upload_pixeldrain") == "true"
     )
-    thread.daemon = True
-    thread.start()
-    return render_template_string(ENCODE_TEMPLATE, filepath=filepath, suggested_output=output_filename, download_started=True)
+    return COMPILED_ENCODE_TEMPLATE.render(filepath=filepath, suggested_output=output_filename, download_started=True, job_id=job_id)
 
 @app.route("/operation_complete")
 def operation_complete():
@@ -1360,16 +1893,27 @@ def operation_complete():
 
 @app.route("/download/<path:filepath>")
 def download_file(filepath):
+    if X_ACCEL_PREFIX:
+        full_path = safe_join(DOWNLOAD_FOLDER, filepath)
+        if full_path is None or not os.path.isfile(full_path):
+            abort(404)
+        return Response(headers={
+            "X-Accel-Redirect": X_ACCEL_PREFIX.rstrip('/') + '/' + quote(filepath),
+            "Content-Type": "application/octet-stream",
+            "Content-Disposition": f"attachment; filename*=UTF-8''{quote(os.path.basename(full_path), safe='')}",
+        })
     return send_from_directory(DOWNLOAD_FOLDER, filepath, as_attachment=True)
 
 @app.route("/delete/<path:filepath>", methods=["POST"])
 def delete_file(filepath):
-    full_path = os.path.join(DOWNLOAD_FOLDER, filepath)
-    if not os.path.abspath(full_path).startswith(os.path.abspath(DOWNLOAD_FOLDER)):
+    full_path = download_path(filepath)
+    if full_path is None or full_path == DOWNLOAD_ROOT:
         flash("Invalid path specified.", "error")
         return redirect(url_for('list_files'))
     try:
-        if os.path.isdir(full_path):
+        if os.path.isdir(full_path) and RM:
+            subprocess.run([RM, "-rf", "--", full_path], check=True, **SPAWN_KWARGS)
+        elif os.path.isdir(full_path):
             shutil.rmtree(full_path)
         else:
             os.remove(full_path)
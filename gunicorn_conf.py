@@ -0,0 +1,24 @@
+# Production settings: gunicorn -c gunicorn_conf.py app:app
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+# Jobs and their progress channels live in this process's memory, so there must be
+# exactly one worker; concurrency comes from threads instead. Every open progress
+# page holds a thread for its SSE stream, so keep plenty of them.
+workers = 1
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 32))
+# No preload_app: app.py writes the cookie temp file (removed at exit) and starts
+# the DNS prewarm thread on import, which must happen in the worker itself, not in
+# a master that outlives and re-forks it.
+
+# gthread workers heartbeat from their main thread, so long SSE streams and
+# uploads don't trip this.
+timeout = 120
+graceful_timeout = 30
+keepalive = 75
+
+# /download responses go out through wsgi.file_wrapper, which gunicorn serves with
+# os.sendfile() (page cache straight to the socket) as long as it isn't doing TLS.
+sendfile = True
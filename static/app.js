@@ -0,0 +1,149 @@
+function showNotification(message, type = 'info') {
+    const notification = document.createElement('div');
+    notification.className = `notification ${type}`;
+    notification.textContent = message;
+    document.body.appendChild(notification);
+
+    setTimeout(() => {
+        notification.style.opacity = '0';
+        setTimeout(() => {
+            document.body.removeChild(notification);
+        }, 300);
+    }, 3000);
+}
+
+const MAX_LOG_LINES = 500;
+// The server sends a heartbeat every 15s; three missed ones mean the stream is dead.
+const STREAM_WATCHDOG_MS = 45000;
+
+// Streams a job's progress into the progress container, then redirects to
+// filesUrl (or to completeUrl with the upload link) once the job is DONE.
+// The Cancel button POSTs to cancelUrl while the job is running.
+function watchProgress(progressUrl, filesUrl, completeUrl, cancelUrl) {
+    const progressContainer = document.getElementById('progress-container');
+    const stage = document.getElementById('progress-stage');
+    const progressBar = document.getElementById('progress-bar-inner');
+    const log = document.getElementById('progress-log');
+    const cancelButton = document.getElementById('progress-cancel');
+
+    progressContainer.style.display = 'block';
+
+    // Appends as text nodes (never parsed as HTML) and drops the oldest messages
+    // once the log holds more than MAX_LOG_LINES lines.
+    const logLineCounts = [];
+    let logLines = 0;
+    function appendLog(text) {
+        log.appendChild(document.createTextNode(text));
+        const lines = text.split('\n').length - 1;
+        logLineCounts.push(lines);
+        logLines += lines;
+        while (logLines > MAX_LOG_LINES && log.firstChild) {
+            log.removeChild(log.firstChild);
+            logLines -= logLineCounts.shift();
+        }
+        log.scrollTop = log.scrollHeight;
+    }
+
+    if (cancelButton && cancelUrl) {
+        cancelButton.style.display = 'inline-block';
+        cancelButton.onclick = function() {
+            cancelButton.disabled = true;
+            stage.textContent = 'Cancelling...';
+            fetch(cancelUrl, { method: 'POST' });
+        };
+    }
+
+    let eventSource = null;
+    let lastEventId = '';
+    let watchdog = null;
+    let finalUrl = null; // Variable to store the final URL from the upload
+
+    function resetWatchdog() {
+        clearTimeout(watchdog);
+        watchdog = setTimeout(reconnect, STREAM_WATCHDOG_MS);
+    }
+
+    function stop() {
+        clearTimeout(watchdog);
+        eventSource.close();
+    }
+
+    // Reopens a stalled stream, asking only for the messages after the last one seen.
+    function reconnect() {
+        eventSource.close();
+        const sep = progressUrl.includes('?') ? '&' : '?';
+        connect(lastEventId ? progressUrl + sep + 'last_event_id=' + encodeURIComponent(lastEventId) : progressUrl);
+    }
+
+    function connect(url) {
+        eventSource = new EventSource(url);
+        eventSource.onmessage = onMessage;
+        eventSource.addEventListener('heartbeat', resetWatchdog);
+        eventSource.onerror = onError;
+        resetWatchdog();
+    }
+
+    function onMessage(event) {
+        resetWatchdog();
+        if (event.lastEventId) lastEventId = event.lastEventId;
+        try {
+            const data = JSON.parse(event.data);
+
+            if (data.final_url) {
+                finalUrl = data.final_url;
+            }
+
+            if (data.log && data.log === 'DONE') {
+                stop();
+                if (cancelButton) cancelButton.style.display = 'none';
+                stage.textContent = '✅ Completed!';
+                progressBar.style.backgroundColor = '#28a745';
+                appendLog("\nOperation finished. Redirecting...\n");
+
+                let redirectTarget = filesUrl;
+                if (finalUrl) {
+                    redirectTarget = completeUrl + "?url=" + encodeURIComponent(finalUrl);
+                }
+
+                setTimeout(() => { window.location.href = redirectTarget; }, 2000);
+                return;
+            }
+
+            if (data.error) {
+                stop();
+                if (cancelButton) cancelButton.style.display = 'none';
+                stage.textContent = '❌ Error!';
+                progressBar.style.backgroundColor = '#dc3545';
+                appendLog(`\nERROR: ${data.error}\n`);
+                showNotification('Operation failed: ' + data.error, 'error');
+                return;
+            }
+
+            if (data.stage) {
+                stage.textContent = data.stage;
+            }
+            if (data.percent) {
+                progressBar.style.width = data.percent + '%';
+                progressBar.textContent = data.percent.toFixed(1) + '%';
+            }
+            if (data.log) {
+                appendLog(data.log + '\n');
+            }
+        } catch (e) {
+            console.error('Error parsing SSE data:', e);
+        }
+    }
+
+    // The browser retries on its own (resending Last-Event-ID) unless it gave up.
+    function onError(err) {
+        console.error('SSE error:', err);
+        if (eventSource.readyState === EventSource.CLOSED) {
+            clearTimeout(watchdog);
+            stage.textContent = 'Connection error. Please refresh.';
+        } else {
+            stage.textContent = 'Connection lost, reconnecting...';
+        }
+    }
+
+    connect(progressUrl);
+}
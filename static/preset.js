@@ -0,0 +1,103 @@
+// Codec-dependent preset/CRF/bitrate controls shared by the download and encode forms.
+const codecSelect = document.getElementById('codec');
+const presetSelect = document.getElementById('preset');
+const crfInput = document.getElementById('crf');
+const passModeSelect = document.getElementById('pass_mode');
+const bitrateInput = document.getElementById('bitrate');
+
+// Presets for hardware encoders, keyed by the encoder name's vendor suffix.
+// VAAPI and VideoToolbox have no presets; their quality is set by CRF (mapped to
+// QP or -q:v) alone.
+const hwPresets = {
+    nvenc: { presets: ['p1', 'p2', 'p3', 'p4', 'p5', 'p6', 'p7'], selected: 'p5' },
+    qsv: { presets: ['veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow'], selected: 'medium' },
+    vaapi: { presets: [], selected: null },
+    videotoolbox: { presets: [], selected: null },
+};
+
+function updatePresetOptions() {
+    const codec = codecSelect.value;
+    presetSelect.innerHTML = '';
+    if (codec === 'av1') {
+        for (let p = 0; p <= 13; p++) {
+            let label = p.toString();
+            if (p === 0) label += ' (slowest)';
+            else if (p === 13) label += ' (fastest)';
+            else if (p > 7) label += ' (fast)';
+            else label += ' (medium)';
+            const option = document.createElement('option');
+            option.value = p;
+            option.text = label;
+            if (p === 6) option.selected = true;
+            presetSelect.appendChild(option);
+        }
+        crfInput.value = crfInput.value || '35';
+        crfInput.placeholder = 'e.g., 35 for AV1';
+    } else if (codec === 'h265') {
+        const presets = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow', 'placebo'];
+        presets.forEach(p => {
+            const option = document.createElement('option');
+            option.value = p;
+            option.text = p;
+            if (p === 'faster') option.selected = true;
+            presetSelect.appendChild(option);
+        });
+        crfInput.value = crfInput.value || '28';
+        crfInput.placeholder = 'e.g., 28 for H.265';
+    } else if (hwPresets[codec.split('_').pop()]) {
+        const hw = hwPresets[codec.split('_').pop()];
+        hw.presets.forEach(p => {
+            const option = document.createElement('option');
+            option.value = p;
+            option.text = p;
+            if (p === hw.selected) option.selected = true;
+            presetSelect.appendChild(option);
+        });
+        const defaultQuality = codec.startsWith('av1') ? '35' : '28';
+        crfInput.value = crfInput.value || defaultQuality;
+        crfInput.placeholder = 'e.g., ' + defaultQuality;
+    }
+    const encodingOptions = document.getElementById('encoding-options');
+    encodingOptions.style.display = codec !== 'none' ? 'block' : 'none';
+
+    if (codec === 'none') {
+        bitrateInput.removeAttribute('required');
+        bitrateInput.removeAttribute('min');
+        bitrateInput.value = '';
+    } else {
+        bitrateInput.setAttribute('min', '100');
+        if (passModeSelect.value === '2-pass') {
+            bitrateInput.setAttribute('required', 'required');
+        } else {
+            bitrateInput.removeAttribute('required');
+        }
+    }
+}
+
+function validateForm() {
+    const codec = codecSelect.value;
+    if (codec !== 'none') {
+        if (!presetSelect.value && presetSelect.options.length) {
+            alert('Please select a preset.');
+            return false;
+        }
+        if (passModeSelect.value === '2-pass' && (!bitrateInput.value || parseInt(bitrateInput.value) < 100)) {
+            alert('Please specify a valid video bitrate (minimum 100) for 2-pass encoding.');
+            return false;
+        }
+    }
+    return true;
+}
+
+codecSelect.addEventListener('change', updatePresetOptions);
+passModeSelect.addEventListener('change', function() {
+    if (codecSelect.value !== 'none') {
+        if (this.value === '2-pass') {
+            bitrateInput.setAttribute('required', 'required');
+        } else {
+            bitrateInput.removeAttribute('required');
+        }
+    }
+});
+
+document.addEventListener('DOMContentLoaded', updatePresetOptions);
@@ -0,0 +1,60 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yt_dlp
+
+import app
+
+
+def cached_info():
+    """An extraction as get_info caches it: already through the default selection."""
+    info = {
+        'id': 'vid', 'title': 'Video', 'duration': 10,
+        'extractor': 'test', 'extractor_key': 'Test', 'webpage_url': 'http://example.com/watch',
+        'formats': [
+            {'format_id': '18', 'url': 'http://example.com/m.mp4', 'ext': 'mp4',
+             'vcodec': 'avc1', 'acodec': 'mp4a', 'height': 360, 'filesize': 1000},
+            {'format_id': '137', 'url': 'http://example.com/v.mp4', 'ext': 'mp4',
+             'vcodec': 'avc1', 'acodec': 'none', 'height': 1080, 'filesize': 5000},
+            {'format_id': '140', 'url': 'http://example.com/a.m4a', 'ext': 'm4a',
+             'vcodec': 'none', 'acodec': 'mp4a', 'filesize': 500},
+        ],
+    }
+    # yt-dlp's default when ffmpeg is available.
+    with yt_dlp.YoutubeDL({'format': 'bv*+ba/b', 'quiet': True}) as ydl:
+        info = ydl.process_ie_result(info, download=False)
+    assert info.get('requested_formats')
+    return info
+
+
+class DownloadInfoTest(unittest.TestCase):
+    def downloaded_urls(self, selector):
+        urls = []
+        with yt_dlp.YoutubeDL({'format': selector, 'quiet': True}) as ydl:
+            ydl.process_info = lambda info: urls.extend(
+                f['url'] for f in info.get('requested_formats') or [info])
+            app.download_info(ydl, cached_info())
+        return urls
+
+    def test_muxed_format(self):
+        self.assertEqual(self.downloaded_urls('18'), ['http://example.com/m.mp4'])
+
+    def test_video_only_format(self):
+        self.assertEqual(self.downloaded_urls('137'), ['http://example.com/v.mp4'])
+
+    def test_video_and_audio_pair(self):
+        self.assertEqual(self.downloaded_urls('137+140'),
+                         ['http://example.com/v.mp4', 'http://example.com/a.m4a'])
+
+    def test_free_space_check_sizes_the_selection(self):
+        with yt_dlp.YoutubeDL({'format': '18', 'quiet': True}) as ydl:
+            selected = ydl.process_ie_result(app.unselected_info(cached_info()), download=False)
+        self.assertNotIn('requested_formats', selected)
+        self.assertEqual(selected['filesize'], 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()